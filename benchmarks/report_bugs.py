@@ -2,6 +2,8 @@ from argparse import ArgumentParser
 import sys
 import os
 
+from orbis import ktest
+
 
 def src_dir(program):
     if ("xorriso" in program) or ("sed" in program):
@@ -83,7 +85,17 @@ def log_err_replays(fd_name, err_file, program, src):
     return None
 
 
-def extract_crash_tc(fd_name, table):
+def ktest_arguments(tc_path, program):
+    # Arguments as klee-replay prints them, read from the test case instead of its stderr
+    try:
+        with ktest.KTest(tc_path) as test:
+            argv = test.argv(program)
+    except (OSError, ValueError):
+        return None
+    return "".join('"%s" ' % arg for arg in argv)
+
+
+def extract_crash_tc(fd_name, table, program):
     print("[INFO] ParaSuit : Checking crashed testcases from %s directory" % (fd_name))
     with open('./%s/errors' % (fd_name), 'r', encoding='ISO-8859-1') as err_file:
         lines = err_file.read()
@@ -97,8 +109,9 @@ def extract_crash_tc(fd_name, table):
             test_file = lines[l]
             idx_tf = test_file.find("/%s" % (fd_name))
             tc_path = test_file[idx_tf:-1]
+            args = ktest_arguments(".%s" % tc_path, "./%s" % program[:program.index("-")])
 
-        elif "Arguments:" in lines[l]:
+        elif "Arguments:" in lines[l] and args is None:
             arguments = lines[l]
             idx_arg = arguments.find('"')
             args = arguments[idx_arg:-1]
@@ -171,7 +184,7 @@ def main(*argv):
 
     for fd_name in args.directories:
         log_err_replays(fd_name, err_files, args.benchmark, src)
-        extract_crash_tc(fd_name, args.table)
+        extract_crash_tc(fd_name, args.table, args.benchmark)
 
 
     print("[INFO] ParaSuit : The detected bugs were saved in “%s” file." % (args.table))
@@ -368,9 +368,14 @@ static int copy_file(const char *src, const char *dst) {
 static void clone_symfiles_to_tmp(char out_tmpdir[PATH_MAX], strlist_t *out_paths) {
   sl_init(out_paths);
 
-  char tmpl[] = "/tmp/klee-symfiles-XXXXXX";
+  /* Under TMPDIR when set, and named on stderr, so a caller that kills the replay can still remove it */
+  const char *tmproot = getenv("TMPDIR");
+  if (!tmproot || !tmproot[0]) tmproot = "/tmp";
+  char tmpl[PATH_MAX];
+  snprintf(tmpl, sizeof(tmpl), "%s/klee-symfiles-XXXXXX", tmproot);
   char *tmpdir = mkdtemp(tmpl);
   if (!tmpdir) { perror("mkdtemp"); exit(1); }
+  fprintf(stderr, "KLEE-REPLAY: NOTE: Storing sym-files in %s\n", tmpdir);
   strncpy(out_tmpdir, tmpdir, PATH_MAX);
   out_tmpdir[PATH_MAX-1] = '\0';
 
@@ -1,19 +1,27 @@
 import argparse
+import atexit
+import cProfile
 import csv
 import os
-import pwd
+import random as rd
 import shutil
 import sys
+import threading
 import time
 
-import subprocess as sp
-
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
+from orbis import checkpoint
+from orbis import session
+from orbis.branch import BranchRegistry
 from orbis.extract import Extractor
 from orbis.construct import Constructor
+from orbis.corpus import Corpus
+from orbis.distribute import Coordinator
 from orbis.guide import Guider
 from orbis.klee import KLEE, KLEEAnalyze
+from orbis.telemetry import Telemetry, dump_profile
 
 
 
@@ -33,6 +41,8 @@ def main(argv=None):
                             help='Path to "gen-bout" executable (default=gen-bout)')
     executable.add_argument('--gcov', default='gcov', type=str,
                             help='Path to "gcov" executable (default=gcov)')
+    executable.add_argument('--gcov-tool', default='gcov-tool', type=str,
+                            help='Path to "gcov-tool" executable (default=gcov-tool)')
 
     # Hyperparameters
     hyperparameters = parser.add_argument_group('hyperparameters')
@@ -42,12 +52,45 @@ def main(argv=None):
                                 help='Select the top n test cases with high coverage as candidate seeds (default=10)')
     hyperparameters.add_argument('--init-args', default="-sym-args 0 1 10 -sym-args 0 2 2", type=str, metavar='STR',
                                 help='Initial symbolic argument formats')
+    hyperparameters.add_argument('--warmup', action='store_true',
+                                help='Probe every option not tried yet with a short KLEE run before the scored iterations')
+    hyperparameters.add_argument('--warmup-budget', default=30, type=int, metavar='INT',
+                                help='Time budget of each warm-up probe (default=30)')
+
+    # Parallel settings
+    parallel = parser.add_argument_group('parallel settings')
+    parallel.add_argument('--replay-jobs', default=None, type=int, metavar='INT',
+                          help='Number of test cases replayed concurrently (default=number of cores)')
+    parallel.add_argument('--extract-jobs', default=None, type=int, metavar='INT',
+                          help='Number of options whose constraints are extracted concurrently (default=number of cores)')
+    parallel.add_argument('--warmup-jobs', default=None, type=int, metavar='INT',
+                          help='Number of warm-up probes run concurrently (default=number of cores)')
+    parallel.add_argument('--pipeline', action='store_true',
+                          help='Evaluate the coverage of an iteration while the next KLEE iteration runs')
+    parallel.add_argument('--workers', default=1, type=int, metavar='INT',
+                          help='Number of KLEE instances run concurrently with different option arguments (default=1)')
+    parallel.add_argument('--listen', default=None, type=str, metavar='ADDRESS',
+                          help='Run KLEE on --workers remote "orbis-worker" processes connecting to "HOST:PORT" or a Unix socket path')
+    parallel.add_argument('--authkey', default=None, type=str, metavar='STR',
+                          help='Key shared with remote workers, required with --listen')
 
     # Others
     parser.add_argument('-d', '--output-dir', default='ORBiS_TEST', type=str,
                         help='Directory where experiment results are saved (default=ORBiS_TEST)')
     parser.add_argument('--src-depth', default=1, type=int,
                         help='Depth from the obj-gcov directory to the directory where the gcov file was created (default=1)')
+    parser.add_argument('--per-testcase-coverage', action='store_true',
+                        help='Measure and cache coverage of each test case separately instead of the merged coverage')
+    parser.add_argument('--minimize-corpus', action='store_true',
+                        help='Archive test cases that cover no branch beyond the kept ones (implies --per-testcase-coverage)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the campaign in the output directory from its last checkpoint instead of deleting it')
+    parser.add_argument('--checkpoint-interval', default=300, type=int, metavar='INT',
+                        help='Seconds between checkpoints of the driver state (default=300)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the driver thread with cProfile and write its hot functions to profile.txt at exit')
+    parser.add_argument('--prior', default=list(), action='append', type=str, metavar='DIR',
+                        help='Output directory of an earlier campaign on the same program whose option feedback seeds the option scores (repeatable)')
 
     # Required arguments
     required = parser.add_argument_group('required arguments')
@@ -60,79 +103,309 @@ def main(argv=None):
     required.add_argument('gcov_obj', nargs='?', default=None,
                           help='Executable with gcov support')
     args = parser.parse_args(argv)
+    session.terminate_on_sigterm()
 
 
     if args.budget is None or args.program is None or args.llvm_bc is None or args.gcov_obj is None:
         parser.print_usage()
         print('[INFO] ORBiS : following parameters are required: -t, llvm_bc, gcov_obj')
         sys.exit(1)
+    if args.listen is not None and not args.authkey:
+        # Connections unpickle whatever they receive, so only peers holding a secret key may talk to the coordinator
+        parser.print_usage()
+        print('[INFO] ORBiS : --listen requires --authkey, e.g., --authkey "$(openssl rand -hex 16)"')
+        sys.exit(1)
 
     args.gcov_obj = f"{str(os.getcwd())}/{args.gcov_obj}"
     args.llvm_bc = f"{str(os.getcwd())}/{args.llvm_bc}"
+    if args.minimize_corpus:
+        args.per_testcase_coverage = True
     output_dir = Path(args.output_dir)
     original_path = f"{str(os.getcwd())}/{args.output_dir}"
-    if output_dir.exists():
-        shutil.rmtree(str(output_dir))
-        print(f'[WARNING] ORBiS : Existing output directory is deleted: {output_dir}')
-    output_dir.mkdir(parents=True)
+    checkpoint_path = f"{original_path}/checkpoint.pkl.gz"
+    state = None
+    if args.resume and os.path.exists(checkpoint_path):
+        state = checkpoint.load(checkpoint_path)
+        print(f'[INFO] ORBiS : Resuming from "{checkpoint_path}" at iteration {state["iteration"]} ({state["elapsed"]}s elapsed).')
+    else:
+        if args.resume:
+            print(f'[WARNING] ORBiS : No checkpoint found in {output_dir}. Starting over.')
+        if output_dir.exists():
+            shutil.rmtree(str(output_dir))
+            print(f'[WARNING] ORBiS : Existing output directory is deleted: {output_dir}')
+        output_dir.mkdir(parents=True)
     coverage_csv = f"{original_path}/coverage.csv"
+    events_jsonl = f"{original_path}/events.jsonl"
     print(f'[INFO] ORBiS : Coverage will be recorded at "{coverage_csv}" at every iteration.')
 
     # Initialize Symbolic Executor: Default values of each parameter for symbolic executor
     sym_cmd = args.init_args
     symbolic_executor = KLEE(args.init_args, args.klee)
-    extractor = Extractor(args.program, os.getcwd(), args.output_dir, args.llvm_bc, args.klee, args.gen_bout)
-    constructor = Constructor(args.program, os.getcwd(), args.output_dir)
-    guider = Guider(args.program, os.getcwd(), args.output_dir, args.n_testcases)
+    extractor = Extractor(args.program, os.getcwd(), args.output_dir, args.llvm_bc, args.klee, args.gen_bout, args.extract_jobs)
+    if state is None:
+        registry = BranchRegistry()
+        constructor = Constructor(args.program, os.getcwd(), args.output_dir, registry)
+        guider = Guider(args.program, os.getcwd(), args.output_dir, args.n_testcases)
+        corpus = None
+        if len(args.prior) > 0:
+            warmed = constructor.warm_start(checkpoint.prior(args.prior))
+            print(f'[INFO] ORBiS : Option scores warm-started from earlier campaigns: {warmed}/{len(constructor.option_branches)} options skip the warm-up.')
+    else:
+        # Iterations after the checkpoint are dropped, those in flight at the checkpoint run again below
+        checkpoint.rewind(original_path, state['iteration'], state['rows'], coverage_csv,
+                          [state['pending'][1]] if state['pending'] is not None else [], [launched[0] for launched in state['inflight']])
+        checkpoint.truncate(events_jsonl, state.get('events', 0))
+        registry, constructor, guider, corpus = state['registry'], state['constructor'], state['guider'], state['corpus']
+        rd.setstate(state['random'])
+    if corpus is None and args.minimize_corpus:
+        corpus = Corpus(registry, original_path)
+    elif not args.minimize_corpus:
+        corpus = None
 
     # Start Execution
-    analyzer = KLEEAnalyze(args.init_budget, args.gcov_obj, args.klee_replay, args.gcov)
+    analyzer = KLEEAnalyze(args.init_budget, args.gcov_obj, args.klee_replay, args.gcov, args.gcov_tool, args.replay_jobs, args.per_testcase_coverage,
+                           f"{os.getcwd()}/../data/replay/{args.program}.json", registry)
     analyzer.clear_gcov(args.src_depth)
     start = time.time()
 
     # Initialize Variables
-    total_coverage = set()
+    total_coverage = 0
     new_arg = list()
     seeds = list()
     elapsed = 0
+    rows = 0
     i = 1
+    # Iteration numbers taken by warm-up probes, which the budget schedule does not count
+    warmup_iterations = 0
+    if state is not None:
+        # Learned state comes back as it was, no test case of a finished iteration is replayed
+        total_coverage, new_arg, seeds = state['total_coverage'], state['new_arg'], state['seeds']
+        elapsed, rows, i = state['elapsed'], state['rows'], state['iteration']
+        warmup_iterations = state.get('warmup_iterations', 0)
+        analyzer.budget = state['budget']
+        analyzer.coverage_cache = state['coverage_cache']
+        start = start - elapsed
+        if len(new_arg) > 0:
+            # Seeds evicted after the checkpoint are written again
+            guider.option_seed(new_arg, args.gen_bout)
+    last_checkpoint = time.time()
+    telemetry = Telemetry(events_jsonl, state.get('events', 0) if state is not None else 0)
 
-    print(f'[INFO] ORBiS : All configuration loaded. Start testing.')
-    
-    while elapsed <= args.budget:
-        iteration_dir = output_dir / f'iteration-{i}'
-        time_budget = analyzer.budget_handler(elapsed, args.budget, len(total_coverage), i, list(constructor.option_branches.keys()))
-
-        # Run symbolic executor
-        testcases, runtime = symbolic_executor.run(args.llvm_bc, time_budget, iteration_dir, sym_cmd, new_arg, original_path, args.program, seeds)
-
-        # Collect result
-        coverage = analyzer.evaluate(args.gcov_obj, testcases, args.src_depth)
-        total_coverage = total_coverage.union(coverage)
+    def record(branches, iteration, arguments, runtime, time_budget, testcase_coverage):
+        # Fold the feedback of a finished iteration into the total coverage, the Constructor and the Guider
+        nonlocal total_coverage, elapsed, rows
+        telemetry.scan(iteration, f"{original_path}/iteration-{iteration}")
+        coverage = registry.encode(branches)
+        total_coverage = total_coverage | coverage
         elapsed = int(time.time() - start)
         
-        print(f'[INFO] ORBiS : Iteration: {i} '
+        print(f'[INFO] ORBiS : Iteration: {iteration} '
                         f'Iteration budget: {time_budget} '
                         f'Total budget: {args.budget} '
                         f'Time elapsed: {elapsed} '
-                        f'Used argument: {" ".join(new_arg)} '
-                        f'Coverage: {len(total_coverage)} ')
+                        f'Used argument: {" ".join(arguments)} '
+                        f'Coverage: {registry.count(total_coverage)} ')
 
         with open(coverage_csv, 'a', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow([elapsed, len(total_coverage), " ".join(new_arg)])
+            writer.writerow([elapsed, registry.count(total_coverage), " ".join(arguments)])
+        rows += 1
+
+        with telemetry.phase(iteration, 'update'):
+            constructor.update(coverage, arguments, runtime, time_budget)
+        if corpus is not None:
+            with telemetry.phase(iteration, 'minimize'):
+                testcase_coverage = corpus.minimize(iteration, testcase_coverage)
+        with telemetry.phase(iteration, 'save'):
+            guider.save(arguments, iteration, testcase_coverage)
+        telemetry.emit(iteration, arguments=arguments, budget=time_budget, runtime=runtime, elapsed=elapsed,
+                       branches=len(branches), coverage=registry.count(total_coverage))
+
+    def evaluated(iteration):
+        # The phases of the evaluation that just finished go to the event of its iteration
+        telemetry.add(iteration, analyzer.timings, analyzer.counts)
+        return analyzer.testcase_coverage
+
+    def guide(iteration, arguments, keep=()):
+        with telemetry.phase(iteration, 'guide'):
+            seeds = guider.guide(arguments, args.gen_bout, keep)
+        telemetry.add(iteration, guider.timings)
+        return seeds
+
+    def save_checkpoint(inflight=(), pending=None):
+        # inflight: (iteration, arguments, seeds, budget) of KLEE runs not finished yet, pending: feedback not recorded yet
+        nonlocal last_checkpoint
+        checkpoint.save(checkpoint_path, {'iteration' : i, 'elapsed' : int(time.time() - start), 'rows' : rows,
+                                          'total_coverage' : total_coverage, 'new_arg' : new_arg, 'seeds' : seeds,
+                                          'inflight' : list(inflight), 'pending' : pending,
+                                          'budget' : analyzer.budget, 'warmup_iterations' : warmup_iterations, 'coverage_cache' : analyzer.coverage_cache, 'random' : rd.getstate(),
+                                          'registry' : registry, 'constructor' : constructor, 'guider' : guider, 'corpus' : corpus,
+                                          'events' : telemetry.events})
+        last_checkpoint = time.time()
+
+    evaluation = threading.Lock()
+
+    def launch(slot, iteration, arguments, seeds, time_budget, score_file):
+        # Runs on a worker thread: KLEE instances run side by side, their evaluations take turns
+        iteration_dir = output_dir / f'iteration-{iteration}'
+        with telemetry.phase(iteration, 'klee'):
+            testcases, runtime = symbolic_executor.run(args.llvm_bc, time_budget, iteration_dir, sym_cmd, arguments, original_path, args.program, seeds, score_file=score_file)
+        with evaluation:
+            branches = analyzer.evaluate(args.gcov_obj, testcases, args.src_depth)
+            testcase_coverage = evaluated(iteration)
+        return slot, (branches, iteration, arguments, runtime, time_budget, testcase_coverage)
+
+    def dispatch(slot, iteration, arguments, seeds, time_budget, score_file):
+        # Runs on a worker thread: the remote worker runs KLEE and evaluates, the test cases come back inline
+        with telemetry.phase(iteration, 'remote'):
+            result = coordinator.run(slot, output_dir, iteration, arguments, seeds, time_budget, score_file)
+        if result is None:
+            return slot, None
+        branches, runtime, testcase_coverage = result
+        return slot, (branches, iteration, arguments, runtime, time_budget, testcase_coverage)
+
+    coordinator = Coordinator(args.listen, args.authkey, args.workers) if args.listen is not None else None
+    distributed = args.workers > 1 or coordinator is not None
+    pipeline = ThreadPoolExecutor(max_workers=1) if args.pipeline and not distributed else None
+    pending = None
 
-        constructor.update(coverage, new_arg, runtime, time_budget)
-        guider.save(new_arg, i)
+    if args.profile:
+        # Python phases of the driver thread; KLEE, klee-replay and gcov show up as time spent waiting on them
+        profiler = cProfile.Profile()
+        atexit.register(dump_profile, profiler, f"{original_path}/profile")
+        profiler.enable()
 
-        new_arg = constructor.construct()
-        seeds = guider.guide(new_arg, args.gen_bout)
+    print(f'[INFO] ORBiS : All configuration loaded. Start testing.')
+    if state is not None and state['pending'] is not None:
+        record(*state['pending'])
+
+    if args.warmup and (state is None or len(state['inflight']) == 0):
+        # Options not tried yet get a short probe each, side by side, and the scored iterations start from their feedback
+        options = [key for key, value in constructor.selected_count.items() if not value]
+        jobs = args.warmup_jobs if args.warmup_jobs else (os.cpu_count() or 1)
+        score_file = f"{original_path}/{args.program}.score"
+        slots = list(range(jobs, 0, -1))
+        running = dict()
+        probed = errored = klee_time = 0
+        warmup_start = time.time()
+        print(f'[INFO] ORBiS : Warm-up: probing {len(options)} options for {args.warmup_budget}s each with {jobs} jobs.')
+        with ThreadPoolExecutor(max_workers=jobs) as probers:
+            while True:
+                while len(slots) > 0 and len(options) > 0 and elapsed + args.warmup_budget <= args.budget:
+                    slot = slots.pop()
+                    option = [options.pop(0)]
+                    slot_score = f"{original_path}/{args.program}-warmup-{slot}.score"
+                    shutil.copyfile(score_file, slot_score)
+                    option_seeds = guide(i, option, [seed for launched in running.values() for seed in launched])
+                    running[probers.submit(launch, slot, i, option, option_seeds, args.warmup_budget, slot_score)] = option_seeds
+                    i += 1
+                    warmup_iterations += 1
+
+                if len(running) == 0:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: future.result()[1][1]):
+                    slot, feedback = future.result()
+                    del running[future]
+                    slots.append(slot)
+                    record(*feedback)
+                    probed += 1
+                    klee_time += feedback[3]
+                    if len(feedback[0]) == 0 or feedback[3] < feedback[4]:
+                        errored += 1
+        warmup_time = max(time.time() - warmup_start, 1e-6)
+        print(f'[INFO] ORBiS : Warm-up: {probed} options probed in {int(warmup_time)}s '
+              f'({probed / warmup_time:.2f} probes/s, {klee_time / warmup_time:.1f} KLEE-seconds/s, {errored} errored).')
+        save_checkpoint()
+
+    if distributed:
+        # Each slot owns its score file, so a starting KLEE never reads the one of another slot
+        workers = ThreadPoolExecutor(max_workers=args.workers)
+        score_file = f"{original_path}/{args.program}.score"
+        slots = list(range(args.workers, 0, -1))
+        running = dict()
+        relaunch = list(state['inflight']) if state is not None else list()
+
+        while True:
+            while len(slots) > 0 and elapsed <= args.budget:
+                slot = slots.pop()
+                if len(relaunch) > 0:
+                    # Iterations in flight at the checkpoint run again under their own numbers
+                    iteration, arguments, iteration_seeds, time_budget = relaunch.pop(0)
+                    if len(arguments) > 0:
+                        # The option seed may have left the seed cache since, it is written again if so
+                        guider.option_seed(arguments, args.gen_bout, [seed for launched in running.values() for seed in launched[2]])
+                else:
+                    if i > 1:
+                        with telemetry.phase(i, 'construct'):
+                            new_arg = constructor.construct(busy=[launched[1] for launched in running.values()])
+                        seeds = guide(i, new_arg, [seed for launched in running.values() for seed in launched[2]])
+                    time_budget = analyzer.budget_handler(elapsed, args.budget, registry.count(total_coverage), i - warmup_iterations, list(constructor.option_branches.keys()))
+                    iteration, arguments, iteration_seeds = i, new_arg, seeds
+                    i += 1
+                slot_score = f"{original_path}/{args.program}-{slot}.score"
+                shutil.copyfile(score_file, slot_score)
+                future = workers.submit(launch if coordinator is None else dispatch, slot, iteration, arguments, iteration_seeds, time_budget, slot_score)
+                running[future] = (iteration, arguments, iteration_seeds, time_budget)
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda future: running[future][0]):
+                slot, feedback = future.result()
+                launched = running.pop(future)
+                if feedback is None:
+                    # The remote worker of the slot is gone: the slot is retired and its iteration waits for another one
+                    relaunch.append(launched)
+                    continue
+                slots.append(slot)
+                record(*feedback)
+            with evaluation:
+                if time.time() - last_checkpoint >= args.checkpoint_interval or len(running) == 0:
+                    save_checkpoint(list(running.values()) + relaunch)
+
+        workers.shutdown()
+        if coordinator is not None:
+            if len(coordinator.connections) == 0:
+                print(f'[WARNING] ORBiS : All workers are lost. {len(relaunch)} iterations are left to --resume.')
+            coordinator.close()
+
+    while not distributed and elapsed <= args.budget:
+        iteration_dir = output_dir / f'iteration-{i}'
+        time_budget = analyzer.budget_handler(elapsed, args.budget, registry.count(total_coverage), i - warmup_iterations, list(constructor.option_branches.keys()))
+
+        # Run symbolic executor
+        with telemetry.phase(i, 'klee'):
+            testcases, runtime = symbolic_executor.run(args.llvm_bc, time_budget, iteration_dir, sym_cmd, new_arg, original_path, args.program, seeds)
+
+        if pipeline is None:
+            # Collect result
+            record(analyzer.evaluate(args.gcov_obj, testcases, args.src_depth), i, new_arg, runtime, time_budget, evaluated(i))
+            with telemetry.phase(i + 1, 'construct'):
+                new_arg = constructor.construct()
+        else:
+            # The previous iteration was evaluated while this one ran, so its feedback is folded in one iteration late.
+            # Its arguments stay busy until then, so the next iteration does not repeat them.
+            elapsed = int(time.time() - start)
+            if pending is not None:
+                record(pending[0].result(), *pending[1:], evaluated(pending[1]))
+            pending = (pipeline.submit(analyzer.evaluate, args.gcov_obj, testcases, args.src_depth), i, new_arg, runtime, time_budget)
+            with telemetry.phase(i + 1, 'construct'):
+                new_arg = constructor.construct(busy=[pending[2]])
+
+        seeds = guide(i + 1, new_arg)
         i += 1
 
-        user = pwd.getpwuid(os.getuid()).pw_name
-        find_pgm_command = f"ps -u {user} -o pid,time,comm | grep {args.program}"
-        kill_pgm_command = "awk '$2 > \"00:00:10\" {print $1}' | xargs kill"
-        _ = sp.run(f"{find_pgm_command} | {kill_pgm_command}", shell=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-        analyzer.kill_tmp()
+        if time.time() - last_checkpoint >= args.checkpoint_interval:
+            # The pending evaluation is waited for, so the checkpoint holds its feedback
+            save_checkpoint(pending=None if pending is None else (pending[0].result(), *pending[1:], analyzer.testcase_coverage))
+
+    if pending is not None:
+        record(pending[0].result(), *pending[1:], evaluated(pending[1]))
+        pipeline.shutdown()
+    if not distributed:
+        save_checkpoint()
         
-    print(f'[INFO] ORBiS : Testing done. Achieve {len(total_coverage)} coverage.')
+    print(f'[INFO] ORBiS : Testing done. Achieve {registry.count(total_coverage)} coverage.')
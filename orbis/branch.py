@@ -0,0 +1,71 @@
+import threading
+
+import numpy as np
+
+
+
+class BranchRegistry:
+    def __init__(self):
+        self.index = dict()
+        self.branches = list()
+        self.lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.branches)
+
+
+    def intern(self, branch):
+        # Give each branch (e.g., "../src/csplit.c 2149") a dense integer id
+        # Evaluations intern the branches they cover while the driver records, so new ids are given under the lock
+        bid = self.index.get(branch)
+        if bid is None:
+            with self.lock:
+                bid = self.index.get(branch)
+                if bid is None:
+                    bid = len(self.branches)
+                    self.branches.append(branch)
+                    self.index[branch] = bid
+        return bid
+
+
+    def encode(self, branches):
+        # A set of branches is an integer whose set bits are the ids of its branches
+        ids = [self.intern(branch) for branch in branches]
+        if len(ids) == 0:
+            return 0
+        mask = np.zeros(max(ids) + 1, dtype=bool)
+        mask[ids] = True
+        return int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little')
+
+
+    def mask(self, bits, size=None):
+        # Boolean array over branch ids, e.g., to weigh a set with per-branch scores
+        size = len(self.branches) if size is None else size
+        bits = bits & ((1 << size) - 1)
+        raw = np.frombuffer(bits.to_bytes((size + 7) // 8, 'little'), dtype=np.uint8)
+        return np.unpackbits(raw, bitorder='little')[:size].astype(bool)
+
+
+    def ids(self, bits):
+        return np.flatnonzero(self.mask(bits))
+
+
+    def decode(self, bits):
+        return {self.branches[bid] for bid in self.ids(bits)}
+
+
+    @staticmethod
+    def count(bits):
+        return bin(bits).count('1')
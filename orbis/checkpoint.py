@@ -0,0 +1,86 @@
+import gzip
+import os
+import pickle
+import re
+import shutil
+import tarfile
+
+from pathlib import Path
+
+
+
+CHECKPOINT_VERSION = 2
+ITERATION_DIR = re.compile(r'^iteration-(\d+)(\.tar\.gz)?$')
+
+
+def save(path, state):
+    # Written next to the old checkpoint and swapped in, so a crash mid-write leaves the previous one intact
+    state = dict(state, version=CHECKPOINT_VERSION)
+    with gzip.open(f"{path}.tmp", 'wb', compresslevel=1) as checkpoint_f:
+        pickle.dump(state, checkpoint_f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+
+def load(path):
+    with gzip.open(path, 'rb') as checkpoint_f:
+        state = pickle.load(checkpoint_f)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} was written by another version of ORBiS")
+    return state
+
+
+def rewind(output_dir, iteration, rows, coverage_csv, restore=(), drop=()):
+    # Drop what iterations after the checkpoint and those to run again left behind: their directories, archives and coverage rows
+    output_dir = Path(output_dir)
+    for n in restore:
+        # Iterations recorded again on resume get back the test cases archived after the checkpoint
+        archive = output_dir / 'archive' / f'iteration-{n}.tar.gz'
+        if archive.exists():
+            with tarfile.open(str(archive), 'r:gz') as archive_f:
+                archive_f.extractall(str(output_dir))
+            archive.unlink()
+    for directory in (output_dir, output_dir / 'archive'):
+        if not directory.exists():
+            continue
+        for entry in directory.iterdir():
+            m = ITERATION_DIR.match(entry.name)
+            if m is not None and (int(m.group(1)) >= iteration or int(m.group(1)) in drop):
+                if entry.is_dir():
+                    shutil.rmtree(str(entry))
+                else:
+                    entry.unlink()
+    truncate(coverage_csv, rows)
+
+
+def truncate(path, lines):
+    # Keep the first lines of a log that grows by one line per recorded iteration
+    if os.path.exists(path):
+        with open(path, 'r', newline='') as log_f:
+            kept = log_f.readlines()[:lines]
+        with open(path, 'w', newline='') as log_f:
+            log_f.writelines(kept)
+
+
+def prior(output_dirs):
+    # Option feedback of earlier campaigns on the same program, averaged over the campaigns
+    campaigns = list()
+    for output_dir in output_dirs:
+        path = f"{output_dir}/checkpoint.pkl.gz"
+        try:
+            state = load(path)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            print(f'[WARNING] ORBiS : Prior "{path}" is skipped: {e}')
+            continue
+        campaigns.append((state['registry'], state['constructor']))
+
+    options = dict()
+    for registry, constructor in campaigns:
+        for key in constructor.option_branches.keys():
+            if constructor.selected_count.get(key, 0) == 0:
+                continue
+            option = options.setdefault(key, {'selected' : 0, 'bad' : 0, 'coverage' : list(), 'covered' : set()})
+            option['selected'] += constructor.selected_count[key] / len(campaigns)
+            option['bad'] += constructor.bad_count[key] / len(campaigns)
+            option['coverage'] += constructor.coverage_data[key]
+            option['covered'] |= registry.decode(constructor.covered_set_data[key])
+    return options
@@ -0,0 +1,64 @@
+import re
+
+
+
+# KLEE writes a .const file as one line: ["<expr>", "<expr>", ...] with '"' escaped as '\"'
+CONST_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')
+CONST_ESCAPE = re.compile(r'\\(.)')
+ARG_NAME = re.compile(r'\barg\d+\b')
+
+
+def read_const(path):
+    with open(path, "r") as const_f:
+        line = const_f.readline().strip()
+    return parse_const(line)
+
+
+def parse_const(line):
+    if not line.startswith("[") or not line.endswith("]"):
+        return list()
+    constraints = list()
+    for m in CONST_STRING.finditer(line):
+        constraint = m.group(1)
+        if "\\" in constraint:
+            constraint = CONST_ESCAPE.sub(r'\1', constraint)
+        constraints.append(constraint)
+    return constraints
+
+
+
+class ConstraintTable:
+    def __init__(self):
+        self.index = dict()
+        self.constraints = list()
+        self.raw = dict()
+
+
+    def __len__(self):
+        return len(self.constraints)
+
+
+    def intern(self, constraint):
+        # Constraints that differ only in argument names (e.g., arg01 and arg02) share one id
+        cid = self.raw.get(constraint)
+        if cid is None:
+            normalized = ARG_NAME.sub('arg', constraint)
+            cid = self.index.get(normalized)
+            if cid is None:
+                cid = len(self.constraints)
+                self.index[normalized] = cid
+                self.constraints.append(normalized)
+            self.raw[constraint] = cid
+        return cid
+
+
+    def encode(self, constraints):
+        return frozenset(self.intern(constraint) for constraint in constraints)
+
+
+    def read(self, path):
+        return self.encode(read_const(path))
+
+
+    def decode(self, cids):
+        return {self.constraints[cid] for cid in cids}
@@ -2,73 +2,115 @@ import json
 import numpy as np
 import random as rd
 
-from sklearn.preprocessing import MinMaxScaler
+from orbis.branch import BranchRegistry
+
+
+# Columns of the option feature table
+WOB, BCS, BC, LSO = range(4)
 
 
 
 class Constructor:
-    def __init__(self, pgm, running_dir, test_dir):
+    def __init__(self, pgm, running_dir, test_dir, registry=None):
+        # Branch sets are bitsets over the ids of a registry shared with the driver
+        self.registry = BranchRegistry() if registry is None else registry
         with open(f"{running_dir}/../data/opt_branches/{pgm}.json", "r") as ob_f:
-            self.option_branches = json.load(ob_f)
+            self.option_branches = {key : self.registry.encode(value) for key, value in json.load(ob_f).items()}
         self.pgm = pgm
         self.running_dir = running_dir
         self.test_dir = test_dir
-        self.uncov_branches = {key : set(value) for key, value in self.option_branches.items()}
+        # Option-related branches are interned first, so their ids are the prefix [0, n_ob) of the registry
+        self.n_ob = len(self.registry)
+        self.keys = list()
+        self.rows = dict()
+        self.uncov_matrix = np.zeros((max(len(self.option_branches), 1), self.n_ob), dtype=bool)
+        self.features = np.zeros((max(len(self.option_branches), 1), 4))
         self.selected_count = {key : 0 for key in self.option_branches.keys()}
-        self.covered_set_data = {key : set(value) for key, value in self.option_branches.items()}
+        self.covered_set_data = dict(self.option_branches)
         self.coverage_data = {key : list() for key, value in self.option_branches.items()}
         self.bad_count = {key : 0 for key in self.option_branches.keys()}
         self.scores = {key : 0.5 for key in self.option_branches.keys()}
+        for key, value in self.option_branches.items():
+            self.add_row(key, self.registry.mask(value, self.n_ob))
         self.ob_scores = self.calculate_branch_score()
+        for key in self.keys:
+            self.refresh(key)
 
         with open(f"{running_dir}/{test_dir}/{pgm}.score", "w") as score_f:
             for key, value in self.scores.items():
                 score_f.write(f"{key} {value}\n")
     
 
-    def normalize(self, data):
-        # Function to normalize each feature value used for scoring option arguments
-        values = np.array(list(data.values())).reshape(-1, 1)
-        scaler = MinMaxScaler()
-        normalized_values = scaler.fit_transform(values)
-        normalized_data = {key: round(float(normalized_value), 4) for key, normalized_value in zip(data.keys(), normalized_values)}
-        return normalized_data
+    def warm_start(self, prior):
+        # Options an earlier campaign already tried start from its feedback and skip their round-robin turn
+        for key, option in prior.items():
+            if key not in self.rows:
+                continue
+            self.selected_count[key] += option['selected']
+            self.bad_count[key] += option['bad']
+            self.coverage_data[key] = self.coverage_data[key] + option['coverage']
+            self.covered_set_data[key] = self.covered_set_data[key] | self.registry.encode(option['covered'])
+            self.refresh(key)
+        return len([key for key in prior.keys() if key in self.rows])
+
+
+    def normalize(self, values):
+        # Min-max normalization of a feature column over all option arguments
+        values = np.asarray(values, dtype=float)
+        low = values.min()
+        span = values.max() - low
+        if span < 10 * np.finfo(float).eps:
+            return np.zeros(len(values))
+        return np.round((values - low) / span, 4)
+
+
+    def add_row(self, key, uncovered):
+        # Rows of the feature table and the uncovered-branch matrix grow by doubling
+        row = len(self.keys)
+        if row == len(self.features):
+            self.uncov_matrix = np.concatenate([self.uncov_matrix, np.zeros_like(self.uncov_matrix)])
+            self.features = np.concatenate([self.features, np.zeros_like(self.features)])
+        self.keys.append(key)
+        self.rows[key] = row
+        self.uncov_matrix[row] = uncovered
+        return row
+
+
+    def refresh(self, key):
+        # Recompute the features of a single option argument in place
+        row = self.rows[key]
+        coverage = self.coverage_data[key]
+        selected = self.selected_count[key]
+        self.features[row, WOB] = self.uncov_matrix[row] @ self.ob_scores
+        self.features[row, BCS] = self.registry.count(self.covered_set_data[key])
+        self.features[row, BC] = sum(coverage) / (len(coverage) + 0.001)
+        self.features[row, LSO] = 1 / selected if selected else np.inf
 
 
     def calculate_branch_score(self):
-        ob_count = dict()
-        for value in self.option_branches.values():
-            for val in value:
-                if val in ob_count.keys():
-                    ob_count[val] += 1
-                else:
-                    ob_count[val] = 1
-        ob_scores = {key : 1 / value for key, value in ob_count.items()}
-        norm_ob_scores = self.normalize(ob_scores)
+        ob_count = self.uncov_matrix[:len(self.keys)].sum(axis=0)
+        used = ob_count > 0
+        norm_ob_scores = np.zeros(self.n_ob)
+        if used.any():
+            norm_ob_scores[used] = self.normalize(1 / ob_count[used])
         return norm_ob_scores
 
 
     def score(self):
+        features = self.features[:len(self.keys)]
         # 1. Weighted OB scores (WOB score)
-        wob_data = dict()
-        for key, value in self.uncov_branches.items():
-            score = 0
-            for val in value:
-                score += self.ob_scores[val]
-            wob_data[key] = score
-        norm_wob_data = self.normalize(wob_data)
+        norm_wob_data = self.normalize(features[:, WOB])
 
         # 2. Branch coverages (BC score)
-        bcs_data = {key : len(value) for key, value in self.covered_set_data.items()}
-        norm_bcs_data = self.normalize(bcs_data)
-        bc_data = {key : sum(value) / (len(value) + 0.001) for key, value in self.coverage_data.items()}
-        norm_bc_data = self.normalize(bc_data)
-        total_bc_data = {key : norm_bcs_data[key] + norm_bc_data[key] for key in self.covered_set_data.keys()}
-        norm_total_bc_data = self.normalize(total_bc_data)
-        
+        norm_bcs_data = self.normalize(features[:, BCS])
+        norm_bc_data = self.normalize(features[:, BC])
+        norm_total_bc_data = self.normalize(norm_bcs_data + norm_bc_data)
 
         # 3. Less selected option (LSO score)
-        lso_data = {key : 1 / value for key, value in self.selected_count.items()}
+        # Options never tried (LSO = inf) rank with the least selected tried ones, an infinite value would make every score NaN
+        lso_data = features[:, LSO]
+        finite = np.isfinite(lso_data)
+        lso_data = np.where(finite, lso_data, lso_data[finite].max() if finite.any() else 1)
         norm_lso_data = self.normalize(lso_data)
 
         # # 4. Errored option (EO score)
@@ -81,32 +123,48 @@ class Constructor:
 
         # 6. Calculate total score for each option
         # total_score = {key : lub_data[key] + wob_data[key] + lso_data[key] + eo_data[key] + lo_data[key] for key in lub_data.keys()}
-        total_score = {key : norm_wob_data[key] + norm_total_bc_data[key] + norm_lso_data[key] * 3 for key in wob_data.keys()}
+        total_score = norm_wob_data + norm_total_bc_data + norm_lso_data * 3
         norm_total_score = self.normalize(total_score)
-        return norm_total_score
+        return dict(zip(self.keys, norm_total_score.tolist()))
 
 
-    def select(self, data, bad_options, k=2):
+    def select(self, data, bad_options, k=2, busy=()):
         data = {key : value for key, value in data.items() if key not in bad_options}
         candidates = list(data.keys())
         weights = list(data.values())
-        selected = []
-        for _ in range(k):
-            # Probabilistically select arguments Based on weights.
-            best = rd.choices(candidates, weights=weights, k=1)[0]
-            selected.append(best)
-            # Prevent the same argument from being selected multiple times.
-            index = candidates.index(best)
-            candidates.pop(index)
-            weights.pop(index)
+        # Combinations already running are left out of the draw, a duplicate is only drawn when every combination runs
+        selected = self.draw(candidates, weights, k, busy)
+        if selected is None:
+            print(f'[WARNING] ORBiS : Every option combination is running already. One of them runs twice.')
+            selected = self.draw(candidates, weights, k)
 
         scores = {key : data[key] for key in self.option_branches.keys() if (key not in selected) and (key in data.keys())}
+        if not all(np.isfinite(value) for value in scores.values()):
+            # KLEE reads the scores through -arg-score-file, so a NaN never leaves the Constructor
+            raise ValueError(f"Non-finite option scores: {scores}")
         with open(f"{self.running_dir}/{self.test_dir}/{self.pgm}.score", "w") as score_f:
             for key, value in scores.items():
                 score_f.write(f"{key} {value}\n")
         return selected
 
 
+    def draw(self, candidates, weights, k, busy=(), selected=()):
+        # Probabilistically select arguments based on weights, without repeating one.
+        # A first pick whose every completion is busy is dropped and the next one is drawn.
+        if len(selected) == k or len(candidates) == 0:
+            return list(selected) if " ".join(self.combination(selected)) not in busy else None
+        candidates, weights = list(candidates), list(weights)
+        while len(candidates) > 0:
+            best = rd.choices(candidates, weights=weights if sum(weights) > 0 else None, k=1)[0]
+            index = candidates.index(best)
+            candidates.pop(index)
+            weights.pop(index)
+            drawn = self.draw(candidates, weights, k, busy, selected + (best,))
+            if drawn is not None:
+                return drawn
+        return None
+
+
     def filter(self):
         try:
             q3 = np.percentile(list(self.bad_count.values()), 75)
@@ -119,59 +177,71 @@ class Constructor:
             return list()
 
 
-    def construct(self):
-        unselected = [key for key, value in self.selected_count.items() if not value]
-        if len(unselected) > 0:
-            sampled = [rd.choice(unselected)]
-        else:
-            scores = self.score()
-            bad_options = self.filter()
-            sampled = self.select(scores, bad_options)
+    def combination(self, sampled):
+        # Option arguments the sampled ones make up, e.g., "-a" and "-b" also give the argument "-a -b" when it is an option
         new_argument = " ".join(sampled)
         sampled_filter = list()
         for key in self.option_branches.keys():
             if (f" {key}" in new_argument) or (f"{key} " in new_argument) or (key == new_argument):
                 sampled_filter.append(key)
-
         return sampled_filter
+
+
+    def construct(self, busy=()):
+        # busy: option arguments handed out whose feedback has not been folded in by update() yet
+        busy = {" ".join(arguments) for arguments in busy}
+        unselected = [key for key, value in self.selected_count.items() if not value]
+        # Options never tried go first, unless all of them are running; the others are then drawn by score
+        idle = [key for key in unselected if " ".join(self.combination([key])) not in busy]
+        if len(idle) > 0:
+            sampled = [rd.choice(idle)]
+        else:
+            scores = self.score()
+            bad_options = self.filter()
+            sampled = self.select(scores, bad_options, busy=busy)
+        return self.combination(sampled)
             
 
     def update(self, covered, options, runtime, budget):
         # Update uncovered branch sets
-        for key, value in self.uncov_branches.items():
-            self.uncov_branches[key] = value - covered
+        n = len(self.keys)
+        self.uncov_matrix[:n] &= ~self.registry.mask(covered, self.n_ob)
+        self.features[:n, WOB] = self.uncov_matrix[:n] @ self.ob_scores
 
         # Update errored iteration    
         for option in options:
-            if (len(covered) <= 0) or (runtime < budget):
+            if (covered == 0) or (runtime < budget):
                 self.bad_count[option] += 1
         
         # Update option counts and coverage data
-        options_tmp = " ".join(options).split()
-        for key in self.selected_count.keys():
+        options_tmp = set(" ".join(options).split())
+        for key in self.keys:
             key_set = set(key.split())
-            intersected = key_set.intersection(set(options_tmp))
+            intersected = key_set.intersection(options_tmp)
             if len(intersected) == len(key_set):
-                self.covered_set_data[key] = self.covered_set_data[key].union(covered)
-                self.coverage_data[key].append(len(covered))
-            self.selected_count[key] += len(intersected) / len(key_set)
+                self.covered_set_data[key] = self.covered_set_data[key] | covered
+                self.coverage_data[key].append(self.registry.count(covered))
+            if len(intersected) > 0:
+                self.selected_count[key] += len(intersected) / len(key_set)
+                self.refresh(key)
         
         # Make data for newly generated option configuration
         new_option = " ".join(options)
-        if (len(new_option.strip()) > 0) and (new_option not in self.uncov_branches.keys()):
-            new_uncov_set = set()
-            new_covered_set = set()
+        if (len(new_option.strip()) > 0) and (new_option not in self.rows):
+            new_uncov_set = np.zeros(self.n_ob, dtype=bool)
+            new_covered_set = 0
             new_coverage_list = list()
             counts = list()
             bad_counts = list()
             for option in options:
-                new_uncov_set = new_uncov_set.union(self.uncov_branches[option])
-                new_covered_set = new_covered_set.union(self.covered_set_data[option])
+                new_uncov_set |= self.uncov_matrix[self.rows[option]]
+                new_covered_set = new_covered_set | self.covered_set_data[option]
                 new_coverage_list = new_coverage_list + (self.coverage_data[option])
                 counts.append(self.selected_count[option])
                 bad_counts.append(self.bad_count[option])
-            self.uncov_branches[new_option] = new_uncov_set
             self.selected_count[new_option] = sum(counts) / len(counts)
             self.bad_count[new_option] = sum(bad_counts) / len(bad_counts)
             self.covered_set_data[new_option] = new_covered_set
             self.coverage_data[new_option] = new_coverage_list
+            self.add_row(new_option, new_uncov_set)
+            self.refresh(new_option)
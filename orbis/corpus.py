@@ -0,0 +1,73 @@
+import os
+import tarfile
+
+from pathlib import Path
+
+
+
+class Corpus:
+    def __init__(self, registry, test_dir):
+        self.registry = registry
+        self.test_dir = Path(test_dir)
+        self.archive_dir = self.test_dir / 'archive'
+        self.kept = dict()
+        self.covered = 0
+
+
+    def minimize(self, iteration, testcase_coverage):
+        # Greedy set cover of the iteration's test cases over the branches no kept test case covers yet
+        iteration_dir = self.test_dir / f'iteration-{iteration}'
+        if not iteration_dir.exists():
+            return testcase_coverage
+        candidates = dict()
+        for testcase in sorted(testcase_coverage.keys()):
+            bits = self.registry.encode(testcase_coverage[testcase])
+            if self.crashed(testcase):
+                # Crashing test cases stay where report_bugs.py looks for them
+                self.keep(testcase, bits)
+            else:
+                candidates[testcase] = bits
+
+        kept = [testcase for testcase in testcase_coverage.keys() if testcase in self.kept]
+        gains = {testcase : bits & ~self.covered for testcase, bits in candidates.items()}
+        while len(gains) > 0:
+            testcase = max(gains, key=lambda testcase: self.registry.count(gains[testcase]))
+            if gains[testcase] == 0:
+                break
+            self.keep(testcase, candidates[testcase])
+            kept.append(testcase)
+            gains = {other : bits & ~self.covered for other, bits in gains.items() if other != testcase}
+
+        redundant = [testcase for testcase in candidates.keys() if testcase not in self.kept]
+        self.archive(iteration_dir, redundant)
+        print(f'[INFO] ORBiS : Corpus: kept {len(kept)}/{len(testcase_coverage)} test cases of iteration {iteration}, '
+              f'{len(redundant)} archived ({len(self.kept)} in corpus).')
+        return {testcase : testcase_coverage[testcase] for testcase in kept}
+
+
+    def keep(self, testcase, bits):
+        self.kept[testcase] = bits
+        self.covered = self.covered | bits
+
+
+    def crashed(self, testcase):
+        testcase = Path(testcase)
+        return any(testcase.parent.glob(f'{testcase.stem}.*.err'))
+
+
+    def files(self, testcase):
+        # Every file KLEE wrote for a test case shares its stem, e.g., test000001.ktest and test000001.const
+        testcase = Path(testcase)
+        return sorted(testcase.parent.glob(f'{testcase.stem}.*'))
+
+
+    def archive(self, iteration_dir, testcases):
+        # Redundant test cases are compressed out of the iteration directory, so neither the Guider nor a replay sees them again
+        if len(testcases) == 0:
+            return
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        with tarfile.open(str(self.archive_dir / f'{iteration_dir.name}.tar.gz'), 'w:gz') as archive:
+            for testcase in testcases:
+                for path in self.files(testcase):
+                    archive.add(str(path), arcname=f'{iteration_dir.name}/{path.name}')
+                    os.remove(str(path))
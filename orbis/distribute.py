@@ -0,0 +1,212 @@
+import argparse
+import os
+import shutil
+import sys
+
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+from orbis import session
+from orbis.klee import KLEE, KLEEAnalyze
+
+
+
+def address(spec):
+    # "host:port" is a TCP address, anything else is the path of a Unix socket
+    host, _, port = spec.rpartition(':')
+    if len(host) > 0 and port.isdigit():
+        return (host, int(port))
+    return spec
+
+
+def pack(paths, names=None):
+    # Files travel inline as (name, contents), so coordinator and workers need no shared filesystem
+    names = [Path(path).name for path in paths] if names is None else names
+    files = list()
+    for name, path in zip(names, paths):
+        with open(path, 'rb') as f:
+            files.append((name, f.read()))
+    return files
+
+
+def unpack(files, directory):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = list()
+    for name, contents in files:
+        path = directory / Path(name).name
+        path.write_bytes(contents)
+        paths.append(str(path.absolute()))
+    return paths
+
+
+
+class Coordinator:
+    def __init__(self, listen, authkey, n_workers):
+        self.listener = Listener(address(listen), authkey=authkey.encode())
+        self.connections = dict()
+        for slot in range(1, n_workers + 1):
+            print(f'[INFO] ORBiS : Waiting for worker {slot}/{n_workers} at {listen}.')
+            self.connections[slot] = self.listener.accept()
+        print(f'[INFO] ORBiS : All {n_workers} workers connected.')
+
+
+    def run(self, slot, output_dir, iteration, arguments, seeds, budget, score_file):
+        connection = self.connections[slot]
+        with open(score_file, 'rb') as score_f:
+            score = score_f.read()
+        try:
+            connection.send({'iteration' : iteration,
+                             'arguments' : arguments,
+                             'seeds' : pack(seeds, [f"seed-{k}.ktest" for k in range(len(seeds))]),
+                             'budget' : budget,
+                             'score' : score})
+            result = connection.recv()
+        except (EOFError, OSError) as e:
+            # A worker that died or disconnected is dropped and the driver runs its iteration again elsewhere
+            print(f'[WARNING] ORBiS : Worker {slot} is lost ({type(e).__name__}) while running iteration {iteration}.')
+            self.drop(slot)
+            return None
+
+        # Test cases land in the iteration directory the Guider reads, as if KLEE had run here
+        iteration_dir = Path(output_dir) / f'iteration-{iteration}'
+        unpack(result['files'], iteration_dir)
+        testcase_coverage = {str((iteration_dir / name).absolute()) : frozenset(branches) for name, branches in result['testcase_coverage'].items()}
+        return set(result['branches']), result['runtime'], testcase_coverage
+
+
+    def drop(self, slot):
+        try:
+            self.connections.pop(slot).close()
+        except OSError:
+            pass
+
+
+    def close(self):
+        for connection in self.connections.values():
+            try:
+                connection.send(None)
+                connection.close()
+            except OSError:
+                pass
+        self.listener.close()
+
+
+
+class Worker:
+    def __init__(self, program, llvm_bc, gcov_obj, symbolic_executor, analyzer, src_depth=1):
+        self.program = program
+        self.llvm_bc = llvm_bc
+        self.gcov_obj = gcov_obj
+        self.symbolic_executor = symbolic_executor
+        self.analyzer = analyzer
+        self.src_depth = src_depth
+        self.analyzer.clear_gcov(src_depth)
+
+
+    def serve(self, connect, authkey):
+        connection = Client(address(connect), authkey=authkey.encode())
+        print(f'[INFO] ORBiS : Connected to coordinator at {connect}.')
+        while True:
+            try:
+                job = connection.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            connection.send(self.run(job))
+        connection.close()
+
+
+    def run(self, job):
+        iteration = job['iteration']
+        iteration_dir = Path(f'iteration-{iteration}')
+        seeds = unpack(job['seeds'], f'seeds-{iteration}')
+        score_file = f"{os.getcwd()}/{self.program}.score"
+        with open(score_file, 'wb') as score_f:
+            score_f.write(job['score'])
+
+        testcases, runtime = self.symbolic_executor.run(self.llvm_bc, job['budget'], iteration_dir, self.symbolic_executor.init_args, job['arguments'],
+                                                        os.getcwd(), self.program, seeds, score_file=score_file)
+        branches = self.analyzer.evaluate(self.gcov_obj, testcases, self.src_depth)
+        print(f'[INFO] ORBiS : Iteration: {iteration} '
+              f'Iteration budget: {job["budget"]} '
+              f'Used argument: {" ".join(job["arguments"])} '
+              f'Branches: {len(branches)} ')
+
+        # Every file KLEE wrote for a test case goes back, .err included, so crashes reach report_bugs.py and the corpus keeps them
+        files = [str(path) for testcase in testcases for path in sorted(Path(testcase).parent.glob(f'{Path(testcase).stem}.*'))]
+        testcase_coverage = {Path(testcase).name : sorted(covered) for testcase, covered in self.analyzer.testcase_coverage.items()}
+        return {'branches' : sorted(branches),
+                'runtime' : runtime,
+                'files' : pack(files),
+                'testcase_coverage' : testcase_coverage}
+
+
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog='orbis-worker')
+
+    # Execution settings
+    executable = parser.add_argument_group('executable settings')
+    executable.add_argument('--klee', default=f'{str(os.getcwd())}/../engine/klee/build/bin/klee', type=str,
+                            help='Path to "klee" executable (default=klee)')
+    executable.add_argument('--klee-replay', default=f'{str(os.getcwd())}/../engine/klee/build/bin/klee-replay', type=str,
+                            help='Path to "klee-replay" executable (default=klee-replay)')
+    executable.add_argument('--gcov', default='gcov', type=str,
+                            help='Path to "gcov" executable (default=gcov)')
+    executable.add_argument('--gcov-tool', default='gcov-tool', type=str,
+                            help='Path to "gcov-tool" executable (default=gcov-tool)')
+    executable.add_argument('--init-args', default="-sym-args 0 1 10 -sym-args 0 2 2", type=str, metavar='STR',
+                            help='Initial symbolic argument formats')
+
+    # Coordinator settings
+    coordinator = parser.add_argument_group('coordinator settings')
+    coordinator.add_argument('--connect', default=None, type=str, metavar='ADDRESS',
+                             help='Address of the coordinator, "HOST:PORT" or the path of a Unix socket')
+    coordinator.add_argument('--authkey', default=None, type=str, metavar='STR',
+                             help='Key shared with the coordinator (required)')
+
+    # Others
+    parser.add_argument('-d', '--work-dir', default='ORBiS_WORKER', type=str,
+                        help='Directory where KLEE iterations of this worker are run (default=ORBiS_WORKER)')
+    parser.add_argument('--src-depth', default=1, type=int,
+                        help='Depth from the obj-gcov directory to the directory where the gcov file was created (default=1)')
+    parser.add_argument('--replay-jobs', default=None, type=int, metavar='INT',
+                        help='Number of test cases replayed concurrently (default=number of cores)')
+    parser.add_argument('--per-testcase-coverage', action='store_true',
+                        help='Measure and cache coverage of each test case separately instead of the merged coverage')
+
+    # Required arguments
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-p', '--program', default=None, type=str, metavar='STR',
+                          help='Name of program to test. Write both name and version. (e.g., grep-3.4)')
+    required.add_argument('llvm_bc', nargs='?', default=None,
+                          help='LLVM bitecode file for klee')
+    required.add_argument('gcov_obj', nargs='?', default=None,
+                          help='Executable with gcov support')
+    args = parser.parse_args(argv)
+    session.terminate_on_sigterm()
+
+    if args.connect is None or not args.authkey or args.program is None or args.llvm_bc is None or args.gcov_obj is None:
+        parser.print_usage()
+        print('[INFO] ORBiS : following parameters are required: --connect, --authkey, -p, llvm_bc, gcov_obj')
+        sys.exit(1)
+
+    args.gcov_obj = f"{str(os.getcwd())}/{args.gcov_obj}"
+    args.llvm_bc = f"{str(os.getcwd())}/{args.llvm_bc}"
+    work_dir = Path(args.work_dir)
+    if work_dir.exists():
+        shutil.rmtree(str(work_dir))
+        print(f'[WARNING] ORBiS : Existing work directory is deleted: {work_dir}')
+    work_dir.mkdir(parents=True)
+    os.chdir(str(work_dir))
+
+    symbolic_executor = KLEE(args.init_args, args.klee)
+    analyzer = KLEEAnalyze(0, args.gcov_obj, args.klee_replay, args.gcov, args.gcov_tool, args.replay_jobs, args.per_testcase_coverage)
+    worker = Worker(args.program, args.llvm_bc, args.gcov_obj, symbolic_executor, analyzer, args.src_depth)
+    worker.serve(args.connect, args.authkey)
+    print(f'[INFO] ORBiS : Coordinator closed the connection. Worker done.')
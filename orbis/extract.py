@@ -3,62 +3,102 @@ import os
 import shutil
 import subprocess as sp
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from orbis import ktest
+from orbis import session
+from orbis.constraint import read_const
+
 
 
 class Extractor:
-    def __init__(self, pgm, running_dir, test_dir, target, klee_bin, bout_bin):
+    def __init__(self, pgm, running_dir, test_dir, target, klee_bin, bout_bin, jobs=None):
         with open(f"{running_dir}/../data/option_dict/{pgm}.dict", "r") as option_dict:
             self.options = [line.strip() for line in option_dict.readlines() if line[0] != "#"]
         self.pgm = pgm
         self.running_dir = running_dir
         self.test_dir = f"{running_dir}/{test_dir}"
-        if not os.path.exists(f"{running_dir}/../data/constraints/{pgm}.json"):
-            print("[INFO] ORBiS : Start extracting each option's cosntraints.")
-            self.extract_option_constraints(target, klee_bin, bout_bin)
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        self.const_path = f"{running_dir}/../data/constraints/{pgm}.json"
+        self.partial_path = f"{self.const_path}.partial"
+
+        # Constraints are extracted once per program; options done by an interrupted extraction are kept in the .partial file
+        if not os.path.exists(self.const_path):
+            const_data = dict()
+            if os.path.exists(self.partial_path):
+                with open(self.partial_path, "r") as const_f:
+                    const_data = json.load(const_f)
+            if len(const_data) == 0:
+                print("[INFO] ORBiS : Start extracting each option's cosntraints.")
+            else:
+                print(f"[INFO] ORBiS : Resume extracting each option's cosntraints ({len(const_data)}/{len(self.options)} done).")
+            self.extract_option_constraints(target, klee_bin, bout_bin, const_data=const_data)
 
     
-    def extract_option_constraints(self, target, klee_bin, bout_bin, budget=60):
-        const_data = dict()
-        for option in self.options:
-            print(f"[INFO] ORBiS : Extracting cosntraints of option {option}.")
-            bout_cmd = f'{bout_bin} "{option}" --bout-file {self.test_dir}/option_seed.ktest'
-            os.system(bout_cmd)
+    def extract_option_constraints(self, target, klee_bin, bout_bin, budget=60, const_data=None):
+        const_data = dict() if const_data is None else const_data
+        todo = [(k, option) for k, option in enumerate(self.options) if option not in const_data]
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = {pool.submit(self.extract, k, option, target, klee_bin, bout_bin, budget) : option for k, option in todo}
+            for future in as_completed(futures):
+                const_data[futures[future]] = future.result()
+                self.checkpoint(const_data)
+        self.checkpoint(const_data)
+        os.replace(self.partial_path, self.const_path)
+        shutil.rmtree(f"{self.test_dir}/extract", ignore_errors=True)
 
-            arguments = option.split()
-            arg_cmd = ""
-            for arg in arguments:
-                arg_cmd = f"{arg_cmd} -sym-arg {len(arg)}".lstrip()
-            cmd = " ".join([klee_bin, f"-output-dir={self.test_dir}/test", f"-seed-file={self.test_dir}/option_seed.ktest", 
-                            "-allow-seed-extension", "-allow-seed-truncation", "-simplify-sym-indices", "-output-module", 
-                            "-max-memory=1000", "-only-seed", "-disable-inlining", "-optimize", "-use-forked-solver", 
-                            "-use-cex-cache", "-libc=uclibc", "-posix-runtime", f"-seed-time={budget}", "-external-calls=all", 
-                            "-only-output-states-covering-new", "-max-sym-array-size=4096", "-max-solver-time=30s", f"-max-time={budget}",
-                            "-watchdog", "-max-memory-inhibit=false","-max-static-fork-pct=1", "-max-static-solve-pct=1", "-max-static-cpfork-pct=1", 
-                            "-switch-type=internal", "-search=random-path -search=nurs:covnew", "-use-batching-search", "-batch-instructions=10000", 
-                            str(target), arg_cmd, "-sym-stdin 8", "-sym-stdout"])
-            try:
-                result = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True, check=True, timeout=int(1.25*budget))
 
-            except sp.TimeoutExpired:
-                print('[WARNING] ORBiS : KLEE exceeded the time budget. Iteration terminated.')
+    def checkpoint(self, const_data):
+        # Written in the order of the option dictionary and renamed into place, so an interruption never leaves a torn file
+        ordered = {option : const_data[option] for option in self.options if option in const_data}
+        with open(f"{self.partial_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(ordered, f, ensure_ascii=False, indent=4)
+        os.replace(f"{self.partial_path}.tmp", self.partial_path)
 
-            except sp.CalledProcessError as e:
-                stderr = e.stderr.decode(errors='replace')
-                lastline = stderr.strip().splitlines()[-1]
-                if 'KLEE' in lastline and 'kill(9)' in lastline:
-                    print(f'[WARNING] ORBiS : KLEE process kill(9)ed. Failed to terminate nicely.')
-                else:                
-                    print(f'[WARNING] ORBiS : Fail({e.returncode})ed to execute KLEE.')
 
-            constraints = [f"{self.test_dir}/test/{f}" for f in os.listdir(f"{self.test_dir}/test") if f.endswith(".const")]
-            option_consts = set()
-            for constraint in constraints:
-                with open(constraint, "r") as const_f:
-                    const_list = [line.strip() for line in const_f.readlines()][0]
-                    const_list = eval(const_list)
-                option_consts = option_consts.union(set(const_list))
-            const_data[option] = list(option_consts)
-            shutil.rmtree(f"{self.test_dir}/test")
+    def extract(self, k, option, target, klee_bin, bout_bin, budget=60):
+        # Every option has its own scratch directory, so concurrent KLEE runs never share seed or output paths
+        print(f"[INFO] ORBiS : Extracting cosntraints of option {option}.")
+        scratch = f"{self.test_dir}/extract/{k}"
+        shutil.rmtree(scratch, ignore_errors=True)
+        os.makedirs(scratch)
+        with open(f"{scratch}/option_seed.ktest", "wb") as bout_f:
+            bout_f.write(ktest.gen_bout([option], bout_bin))
 
-        with open(f"{self.running_dir}/../data/constraints/{self.pgm}.json", "w", encoding="utf-8") as f:
-            json.dump(const_data, f, ensure_ascii=False, indent=4)
+        arguments = option.split()
+        arg_cmd = ""
+        for arg in arguments:
+            arg_cmd = f"{arg_cmd} -sym-arg {len(arg)}".lstrip()
+        cmd = " ".join([klee_bin, f"-output-dir={scratch}/test", f"-seed-file={scratch}/option_seed.ktest", 
+                        "-allow-seed-extension", "-allow-seed-truncation", "-simplify-sym-indices", "-output-module", 
+                        "-max-memory=1000", "-only-seed", "-disable-inlining", "-optimize", "-use-forked-solver", 
+                        "-use-cex-cache", "-libc=uclibc", "-posix-runtime", f"-seed-time={budget}", "-external-calls=all", 
+                        "-only-output-states-covering-new", "-max-sym-array-size=4096", "-max-solver-time=30s", f"-max-time={budget}",
+                        "-watchdog", "-max-memory-inhibit=false","-max-static-fork-pct=1", "-max-static-solve-pct=1", "-max-static-cpfork-pct=1", 
+                        "-switch-type=internal", "-search=random-path -search=nurs:covnew", "-use-batching-search", "-batch-instructions=10000", 
+                        str(target), arg_cmd, "-sym-stdin 8", "-sym-stdout"])
+        try:
+            if any(sym in option for sym in ("<(", ">(", "$(", "`")):
+                # Options like --exclude-from=<(echo ...) need bash, /bin/sh has no process substitution
+                result = session.run(["/bin/bash", "-lc", cmd], check=True, timeout=int(1.25*budget))
+            else:
+                result = session.run(cmd, shell=True, check=True, timeout=int(1.25*budget))
+
+        except sp.TimeoutExpired:
+            print('[WARNING] ORBiS : KLEE exceeded the time budget. Iteration terminated.')
+
+        except sp.CalledProcessError as e:
+            stderr = e.stderr.decode(errors='replace')
+            lastline = stderr.strip().splitlines()[-1]
+            if 'KLEE' in lastline and 'kill(9)' in lastline:
+                print(f'[WARNING] ORBiS : KLEE process kill(9)ed. Failed to terminate nicely.')
+            else:                
+                print(f'[WARNING] ORBiS : Fail({e.returncode})ed to execute KLEE.')
+
+        option_consts = set()
+        if os.path.exists(f"{scratch}/test"):
+            constraints = [f"{scratch}/test/{f}" for f in os.listdir(f"{scratch}/test") if f.endswith(".const")]
+            for constraint in constraints:
+                option_consts.update(read_const(constraint))
+        shutil.rmtree(scratch)
+        return sorted(option_consts)
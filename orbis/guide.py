@@ -1,60 +1,131 @@
-import copy
+import hashlib
+import heapq
 import json
 import os
-import re
+import time
 
+import numpy as np
+
+from collections import OrderedDict
+from pathlib import Path
+
+from orbis import ktest
+from orbis.constraint import ConstraintTable
 
 
 class Guider:
-    def __init__(self, pgm, running_dir, test_dir, n_testcases):
+    def __init__(self, pgm, running_dir, test_dir, n_testcases, seed_cache_size=256):
         self.running_dir = running_dir
         self.test_dir = f"{running_dir}/{test_dir}"
-        self.n_testcases = n_testcases
+        self.n_testcases = int(n_testcases)
         self.option_constraints = dict()
+        self.constraints = ConstraintTable()
 
         with open(f"{running_dir}/../data/constraints/{pgm}.json", "r") as const_f:
-            constraints = {key : set(value) for key, value in json.load(const_f).items()}
-            for key, value in constraints.items():
-                self.option_constraints[key] = {re.sub(r'\barg\d+\b', 'arg', s) for s in value}
+            for key, value in json.load(const_f).items():
+                self.option_constraints[key] = set(self.constraints.encode(value))
         self.all_constraints = set().union(*self.option_constraints.values())
         self.seed_data = {key : list() for key in self.option_constraints.keys()}
 
+        # Seed heaps hold (size, -order, test case) with the worst seed on top, the constraint ids of a test case are kept once while some heap holds it
+        self.testcases = dict()
+        self.references = dict()
+        self.order = 0
+
+        # Option seeds are written once per argument string and named by their digest, the least recently used are removed
+        self.seed_cache = OrderedDict()
+        self.seed_cache_size = seed_cache_size
+        self.timings = dict()
+        os.makedirs(f"{self.test_dir}/seeds", exist_ok=True)
 
-    def save(self, arguments, iteration):
+
+    def save(self, arguments, iteration, coverage=None):
         if os.path.exists(f"{self.test_dir}/iteration-{iteration}"):
-            tc_data = list()
-            # Collect all .ktest files from the iteration directory
-            constraints = [f"{self.test_dir}/iteration-{iteration}/{f}" for f in os.listdir(f"{self.test_dir}/iteration-{iteration}") if f.endswith(".const")]
-            for constraint in constraints:
-                with open(constraint, "r") as const_f:
-                    const_list = [line.strip() for line in const_f.readlines()][0]
-                    const_list = eval(const_list)
-                const_list = [re.sub(r'\barg\d+\b', 'arg', s) for s in const_list]
+            # Stream the iteration's test cases through a bounded heap, ranked by constraints, own coverage and then name
+            top = list()
+            names = sorted(f for f in os.listdir(f"{self.test_dir}/iteration-{iteration}") if f.endswith(".const"))
+            for index, name in enumerate(names):
+                constraint = f"{self.test_dir}/iteration-{iteration}/{name}"
                 testcase = constraint.replace(".const", ".ktest")
-                tc_data.append([testcase, set(const_list)])
-            tc_data = sorted(tc_data, key=lambda x: len(x[1]), reverse=True)
-            tc_data = tc_data[:self.n_testcases]
+                ids = np.array(sorted(self.constraints.read(constraint)), dtype=np.uint32)
+                covered = len(coverage.get(str(Path(testcase).absolute()), ())) if coverage else 0
+                entry = (len(ids), covered, -index, testcase, ids)
+                if len(top) < self.n_testcases:
+                    heapq.heappush(top, entry)
+                elif len(top) > 0 and entry[:3] > top[0][:3]:
+                    heapq.heapreplace(top, entry)
+
+            tc_data = list()
+            for size, _, _, testcase, ids in sorted(top, key=lambda x: x[:3], reverse=True):
+                self.testcases[testcase] = ids
+                tc_data.append((size, -self.order, testcase))
+                self.order += 1
             
             # Store top-k seed data based on option argument
             for tmp in arguments:
-                tmp_seed = self.seed_data[tmp] + tc_data
-                tmp_seed = sorted(tmp_seed, key=lambda x: len(x[1]), reverse=True)
-                if len(tmp_seed) >= self.n_testcases:
-                    tmp_seed = tmp_seed[:self.n_testcases]
-                    self.seed_data[tmp] = tmp_seed
-                else:
-                    self.seed_data[tmp] = tmp_seed
+                for entry in tc_data:
+                    self.offer(tmp, entry)
             new_arg = " ".join(arguments)
             if new_arg not in self.seed_data.keys():
-                self.seed_data[new_arg] = tc_data
+                for entry in tc_data:
+                    self.offer(new_arg, entry)
             if new_arg not in self.option_constraints.keys():
                 tmp_set = set()
                 for tmp in arguments:
                     tmp_set = tmp_set.union(self.option_constraints[tmp])
                 self.option_constraints[new_arg] = tmp_set
+
+            # Test cases that made it into no seed heap are forgotten
+            for _, _, testcase in tc_data:
+                if testcase not in self.references:
+                    del self.testcases[testcase]
+
+
+    def offer(self, key, entry):
+        # Older seeds win ties, as they did when the lists were re-sorted stably
+        heap = self.seed_data.setdefault(key, list())
+        if len(heap) < self.n_testcases:
+            heapq.heappush(heap, entry)
+        elif len(heap) > 0 and entry > heap[0]:
+            self.release(heapq.heapreplace(heap, entry)[2])
+        else:
+            return
+        self.references[entry[2]] = self.references.get(entry[2], 0) + 1
+
+
+    def release(self, testcase):
+        self.references[testcase] -= 1
+        if self.references[testcase] == 0:
+            del self.references[testcase]
+            del self.testcases[testcase]
         
 
-    def guide(self, arguments, bout_bin):
+    def option_seed(self, arguments, bout_bin, keep=()):
+        # keep: seeds handed to KLEE runs still in flight, which are never removed
+        arguments_str = " ".join(arguments)
+        bout_file = self.seed_cache.get(arguments_str)
+        if bout_file is not None and os.path.exists(bout_file):
+            self.seed_cache.move_to_end(arguments_str)
+            return bout_file
+
+        data = ktest.gen_bout([arguments_str], bout_bin)
+        bout_file = f"{self.test_dir}/seeds/{hashlib.sha1(data).hexdigest()}.ktest"
+        if not os.path.exists(bout_file):
+            with open(f"{bout_file}.tmp", "wb") as bout_f:
+                bout_f.write(data)
+            os.replace(f"{bout_file}.tmp", bout_file)
+        self.seed_cache[arguments_str] = bout_file
+        self.seed_cache.move_to_end(arguments_str)
+        keep = set(keep) | {bout_file}
+        stale = [key for key, path in self.seed_cache.items() if path not in keep]
+        for key in stale[:max(len(self.seed_cache) - self.seed_cache_size, 0)]:
+            evicted = self.seed_cache.pop(key)
+            if os.path.exists(evicted):
+                os.remove(evicted)
+        return bout_file
+
+
+    def guide(self, arguments, bout_bin, keep=()):
         # Extract argument-related constraints
         opt_related_consts = set()
         for argument in arguments:
@@ -62,31 +133,30 @@ class Guider:
                 opt_related_consts = opt_related_consts.union(self.option_constraints[argument])
 
         # Make concrete seed with sampled arguments
-        arguments_str = " ".join(arguments)
-        bout_cmd = f'{bout_bin} "{arguments_str}" --bout-file {self.test_dir}/option_seed.ktest'
-        os.system(bout_cmd)
-
-        # Extract individual options from the option argument
-        candidates = copy.deepcopy({key : value for key, value in self.seed_data.items() if key in arguments})
+        start = time.monotonic()
+        bout_file = self.option_seed(arguments, bout_bin, keep)
+        self.timings = {'gen_bout' : time.monotonic() - start}
 
         # Select the best seed for each option based on argument similarity
+        related = np.array(sorted(opt_related_consts), dtype=np.uint32)
         seeds = list()
-        for key, values in candidates.items():
+        for key in arguments:
+            values = self.seed_data.get(key, ())
             seed = ""
             if len(values) > 0:
-                max_len = max(len(sc) for _, sc in values)
-                longest_cases = [(tc, sc) for tc, sc in values if len(sc) == max_len]
+                max_len = max(size for size, _, _ in values)
+                longest_cases = [tc for size, _, tc in sorted(values, reverse=True) if size == max_len]
                 if len(longest_cases) == 1:
-                    seed = longest_cases[0][0]
+                    seed = longest_cases[0]
                 elif len(longest_cases) > 1:
                     max_difference = 0
-                    for (tc, sc) in longest_cases:
-                        set_diff = len(set(sc) - opt_related_consts)
+                    for tc in longest_cases:
+                        set_diff = np.count_nonzero(~np.isin(self.testcases[tc], related, assume_unique=True))
                         if set_diff > max_difference:
                             max_difference = set_diff
                             seed = tc
                 if len(seed) > 0:
                     seeds.append(seed)
-        seeds.append(f"{self.test_dir}/option_seed.ktest")
+        seeds.append(bout_file)
         
         return list(set(seeds))
\ No newline at end of file
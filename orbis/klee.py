@@ -1,55 +1,159 @@
 import os
-import glob
+import hashlib
+import json
+import re
+import shutil
+import tempfile
+import threading
 import time
 
 import subprocess as sp
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+
+from orbis import ktest
+from orbis import session
+from orbis.branch import BranchRegistry
+
+
+KLEE_REPLAY_TEMP = re.compile(rb'/[^\s\'"]*/klee-(?:replay|symfiles)-[0-9A-Za-z]{6}')
+
 
 class GCov:
     def __init__(self, bin='gcov'):
         self.bin = bin
+        self.json_format = None
+        self.layouts = dict()
+        self.mirrors = dict()
+        self.lock = threading.Lock()
+
+    def supports_json(self):
+        # gcov >= 9 can stream its JSON intermediate format to stdout
+        if self.json_format is None:
+            try:
+                result = sp.run([str(self.bin), '--help'], stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, errors='replace')
+                self.json_format = ('--json-format' in result.stdout) and ('--stdout' in result.stdout)
+            except OSError:
+                self.json_format = False
+        return self.json_format
 
-    def run(self, target, gcdas, folder_depth=1):
+    def run(self, target, gcdas, folder_depth=1, cleanup=False):
         if len(gcdas) == 0:
             return set()
-
-        original_path = Path().absolute()
-        target_dir = Path(target).parent
+        if self.supports_json():
+            return self.run_json(target, gcdas)
+        return self.run_text(target, gcdas, folder_depth, cleanup)
+
+    def layout(self, target_dir, gcda):
+        # Branch identifiers are positions of the branch lines in the text report, which only depend on the notes file
+        key = os.path.realpath(str(gcda.with_suffix('.gcno')))
+        if key not in self.layouts:
+            cmd = [str(self.bin), '-b', '--stdout', str(gcda)]
+            result = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, cwd=str(target_dir), universal_newlines=True, errors='replace')
+            layout = dict()
+            source = {'headers': list(), 'branches': dict()}
+            index = line_no = 0
+            for line in result.stdout.splitlines():
+                fields = line.split(':', 3)
+                if (len(fields) >= 3) and (fields[1].strip() == '0'):
+                    if fields[2] == 'Source':
+                        source = layout[line.strip().split(':')[-1]] = {'headers': list(), 'branches': dict()}
+                        index = 0
+                    else:
+                        source['headers'].append(fields[2])
+                    continue
+                if (len(fields) >= 2) and fields[1].strip().isdigit():
+                    line_no = int(fields[1])
+                elif line.startswith('branch'):
+                    source['branches'].setdefault(line_no, list()).append(index)
+                index += 1
+            self.layouts[key] = layout
+        return self.layouts[key]
+
+    def run_json(self, target, gcdas):
+        target_dir = Path(target).parent.absolute()
+        gcdas = [Path(gcda).absolute() for gcda in gcdas]
+        layouts = dict()
+        for gcda in gcdas:
+            layouts[os.path.normpath(str(gcda))] = layouts[os.path.realpath(str(gcda))] = self.layout(target_dir, gcda)
+        # gcov leaves the Graph/Data/Runs headers out of the reports when it is given several data files
+        omitted = ('Graph', 'Data', 'Runs') if len(gcdas) > 1 else ()
+
+        cmd = [str(self.bin), '-b', '--json-format', '--stdout', *list(map(str, gcdas))]
+        process = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL, cwd=str(target_dir), universal_newlines=True, errors='replace')
+        # Like the text reports, a source file reported by several objects keeps the data of the last one
+        reports = dict()
+        for document in process.stdout:
+            try:
+                report = json.loads(document)
+            except ValueError:
+                continue
+            data_file = os.path.normpath(str(target_dir / report.get('data_file', '')))
+            layout = layouts.get(data_file, dict())
+            for source in report['files']:
+                file_name = source['file']
+                if file_name not in layout:
+                    continue
+                headers = layout[file_name]['headers']
+                branches = layout[file_name]['branches']
+                offset = len([header for header in headers if header not in omitted])
+                covered = set()
+                for line in source['lines']:
+                    if len(line['branches']) == 0:
+                        continue
+                    indices = branches.get(line['line_number'], ())
+                    for index, branch in zip(indices, line['branches']):
+                        if branch['count'] > 0:
+                            covered.add(f'{file_name} {offset + index}')
+                reports[os.path.basename(file_name)] = covered
+        process.wait()
+        return set().union(*reports.values())
+
+    def run_text(self, target, gcdas, folder_depth=1, cleanup=False):
+        # Reports are written to the working directory, a mirror of the object directory outside the tree
+        work_dir = self.mirror(Path(target).parent)
         gcdas = [gcda.absolute() for gcda in gcdas]
-        os.chdir(str(target_dir))
-
-        cmd = [str(self.bin), '-b', *list(map(str, gcdas))]
-        cmd = ' '.join(cmd)
-        _ = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True, check=True)
-
-        base = Path()
-        for _ in range(folder_depth):
-            if "gawk" in str(target) or "make" in str(target) or "sqlite" in str(target):
-                pass
-            else:
-                base = base / '..'
-
-        gcov_pattern = base / '**/*.gcov'
-        gcovs = list(Path().glob(str(gcov_pattern)))
 
         covered = set()
-        for gcov in gcovs:
-            try:
-                with gcov.open(encoding='UTF-8', errors='replace') as f:
-                    file_name = f.readline().strip().split(':')[-1]
-                    for i, line in enumerate(f):
-                        if ('branch' in line) and ('never' not in line) and ('taken 0%' not in line) and (
-                                ":" not in line) and ("returned 0% blocks executed 0%" not in line):
-                            bid = f'{file_name} {i}'
-                            covered.add(bid)
-            except:
-                pass
+        with self.lock:
+            cmd = [str(self.bin), '-b', *list(map(str, gcdas))]
+            _ = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, cwd=str(work_dir), check=True)
+            for gcov in work_dir.glob('*.gcov'):
+                try:
+                    with gcov.open(encoding='UTF-8', errors='replace') as f:
+                        file_name = f.readline().strip().split(':')[-1]
+                        for i, line in enumerate(f):
+                            if ('branch' in line) and ('never' not in line) and ('taken 0%' not in line) and (
+                                    ":" not in line) and ("returned 0% blocks executed 0%" not in line):
+                                bid = f'{file_name} {i}'
+                                covered.add(bid)
+                except:
+                    pass
+                gcov.unlink()
 
-        os.chdir(str(original_path))
         return covered
 
+    def mirror(self, target_dir):
+        # gcov opens sources by the (often relative) paths recorded at compile time, so the directory it runs in
+        # has the ancestors of the object directory as real directories and everything else linked to the originals
+        target_dir = Path(target_dir).absolute()
+        if target_dir not in self.mirrors:
+            root = Path(tempfile.mkdtemp(prefix='orbis-gcov-', dir=session.sessions().tmpdir))
+            real, mirror = Path(target_dir.anchor), root
+            for part in target_dir.parts[1:] + (None,):
+                for entry in os.scandir(str(real)):
+                    if entry.name != part and not entry.name.endswith('.gcov'):
+                        os.symlink(entry.path, str(mirror / entry.name))
+                if part is not None:
+                    real, mirror = real / part, mirror / part
+                    mirror.mkdir()
+            self.mirrors[target_dir] = mirror
+        return self.mirrors[target_dir]
+
 
 class KLEE:
     def __init__(self, init_args, bin='klee'):
@@ -61,7 +165,7 @@ class KLEE:
         original_path = Path().absolute()
         output_dir = Path(dir_path).absolute()
         dir_path = f"{str(original_path)}/{dir_path}"
-        os.chdir(str(target.parent))
+        score_file = kwargs.get('score_file', f"{test_dir}/{pgm}.score")
 
         if len(arguments) > 0:
             sym_args = ""
@@ -73,7 +177,7 @@ class KLEE:
             seed_cmd = ""
             for seed in seeds:
                 seed_cmd = f"{seed_cmd} -seed-file={seed}".lstrip()
-            cmd = " ".join([self.bin, seed_cmd, "-allow-seed-extension", "-allow-seed-truncation", f"-seed-time={budget // 4}",  f"-arg-score-file={test_dir}/{pgm}.score",
+            cmd = " ".join([self.bin, seed_cmd, "-allow-seed-extension", "-allow-seed-truncation", f"-seed-time={budget // 4}",  f"-arg-score-file={score_file}",
                             f"-output-dir={dir_path}", "-simplify-sym-indices", "-output-module", "-max-memory=1000", "-only-output-states-covering-new",
                             "-disable-inlining", "-optimize", "-use-forked-solver", "-use-cex-cache", "-libc=uclibc", "-posix-runtime",
                             "-external-calls=all", "-max-sym-array-size=4096", "-max-solver-time=30s", f"-max-time={budget}", 
@@ -81,7 +185,7 @@ class KLEE:
                             "-search=random-path -search=nurs:covnew", "-use-batching-search", "-batch-instructions=10000", 
                             str(target), " ".join(arguments), sym_args, "-sym-files 1 8", "-sym-stdin 8", "-sym-stdout"])
         else:
-            cmd = " ".join([self.bin, f"-output-dir={dir_path}", "-simplify-sym-indices", "-output-module", "-max-memory=1000", f"-arg-score-file={test_dir}/{pgm}.score",
+            cmd = " ".join([self.bin, f"-output-dir={dir_path}", "-simplify-sym-indices", "-output-module", "-max-memory=1000", f"-arg-score-file={score_file}",
                             "-disable-inlining", "-optimize", "-use-forked-solver", "-use-cex-cache", "-libc=uclibc", "-posix-runtime", "-only-output-states-covering-new", 
                             "-external-calls=all", "-max-sym-array-size=4096", "-max-solver-time=30s", f"-max-time={budget}", 
                             "-watchdog", "-max-memory-inhibit=false","-max-static-fork-pct=1", "-max-static-solve-pct=1", "-max-static-cpfork-pct=1", "-switch-type=internal", 
@@ -91,7 +195,7 @@ class KLEE:
         needs_bash = any(sym in cmd for sym in ("<(", ">(", "$(", "|", ">", "<", "`"))
         if needs_bash:
             try:
-                result = sp.run(["/bin/bash", "-lc", cmd], stdout=sp.PIPE, stderr=sp.PIPE, check=True, timeout=int(1.25 * budget))
+                result = session.run(["/bin/bash", "-lc", cmd], cwd=str(target.parent), check=True, timeout=int(1.25 * budget))
             except sp.TimeoutExpired:
                 print('[WARNING] SCOPE : KLEE exceeded the time budget. Iteration terminated.')
             except sp.CalledProcessError as e:
@@ -103,7 +207,7 @@ class KLEE:
                     print(f'[WARNING] SCOPE : Fail({e.returncode})ed to execute KLEE.')
         else:
             try:
-                result = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True, check=True, timeout=int(1.25*budget))
+                result = session.run(cmd, shell=True, cwd=str(target.parent), check=True, timeout=int(1.25*budget))
             except sp.TimeoutExpired:
                 print('[WARNING] SCOPE : KLEE exceeded the time budget. Iteration terminated.')
             except sp.CalledProcessError as e:
@@ -117,56 +221,272 @@ class KLEE:
         testcases = list(output_dir.glob('*.ktest'))
         testcases = [tc.absolute() for tc in testcases]
 
-        os.chdir(str(original_path))
-
         return testcases, elapsed
 
 
 class KLEEReplay:
-    def __init__(self, bin='klee-replay'):
+    def __init__(self, bin='klee-replay', gcov_tool='gcov-tool', jobs=None, profile=None):
         self.bin = bin
-
-    def run(self, target, testcases, error_type=None, folder_depth=1):
-        errors = set()
+        self.gcov_tool = gcov_tool
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        # Test cases replayed before their profiles are merged (or measured), which bounds what piles up in scratch
+        self.batch = 8 * self.jobs
+        # Replay timeout follows the measured latencies of the program: p99 * factor, within [floor, cap]
+        self.timeout = 0.1
+        self.timeout_floor = 0.1
+        self.timeout_cap = 5.0
+        self.timeout_factor = 2.0
+        self.latencies = deque(maxlen=2000)
+        self.timeouts = 0
+        self.replays = 0
+        self.reported = 0
+        # A timed-out replay is sent SIGTERM and given a grace period before SIGKILL; those left without any .gcda are counted
+        self.grace = 0.2
+        self.lost = 0
+        # Counters and latencies are updated from the threads of the replay pool
+        self.lock = threading.Lock()
+        self.profile = profile
+        # (--insert-symfiles-argv, --drop-empty-args) of each replay, in the order they are tried
+        self.variants = [("after", True), ("before", True), ("after", False), ("before", False), (None, False)]
+        # Variants found to add coverage; after enough probed test cases the others are no longer replayed
+        self.useful = set()
+        self.probes = 32
+        self.reprobe = 64
+        self.probed = 0
+        self.replayed = 0
+        self.load()
+        self.reported_timeout = self.timeout
+
+    def load(self):
+        # Latencies, timeout and useful variants persisted by earlier runs on the same program
+        if self.profile is None or not os.path.exists(self.profile):
+            return
+        try:
+            with open(self.profile, 'r') as profile_f:
+                profile = json.load(profile_f)
+        except (OSError, ValueError):
+            return
+        self.timeout = profile.get('timeout', self.timeout)
+        self.latencies.extend(profile.get('latencies', []))
+        self.useful = {tuple(variant) for variant in profile.get('useful', [])}
+        self.probed = profile.get('probed', 0)
+
+    def save(self):
+        if self.profile is None:
+            return
+        profile = {'timeout' : self.timeout,
+                   'timeouts' : self.timeouts,
+                   'replays' : self.replays,
+                   'latencies' : [round(latency, 4) for latency in self.latencies],
+                   'useful' : [list(variant) for variant in self.variants if variant in self.useful],
+                   'probed' : self.probed}
+        profile_dir = os.path.dirname(os.path.abspath(self.profile))
+        os.makedirs(profile_dir, exist_ok=True)
+        # Campaigns on the same program may save at the same time, each through a temporary file of its own
+        fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.profile)}.", suffix='.tmp', dir=profile_dir)
+        with os.fdopen(fd, 'w') as profile_f:
+            json.dump(profile, profile_f)
+        os.replace(tmp_path, self.profile)
+
+    def tune(self):
+        # Timed-out replays are recorded at the timeout, so a program that keeps hitting it gets a longer one
+        if len(self.latencies) > 0:
+            timeout = float(np.percentile(np.array(self.latencies), 99)) * self.timeout_factor
+            timeout = round(min(max(timeout, self.timeout_floor), self.timeout_cap), 3)
+            # Reported on new timeouts or once the timeout drifted by more than 10% from the last reported one
+            if self.timeouts > self.reported or abs(timeout - self.reported_timeout) > 0.1 * self.reported_timeout:
+                print(f'[INFO] ORBiS : Replay timeout: {self.reported_timeout}s -> {timeout}s ({self.timeouts}/{self.replays} replays timed out so far, '
+                      f'{self.lost} test cases lost their coverage profile).')
+                self.reported_timeout = timeout
+            self.timeout = timeout
+        self.reported = self.timeouts
+        self.save()
+
+    def plan(self, testcase):
+        # Inserting sym-files only changes argv when the test case creates sym-files, dropping empty arguments only when it has some.
+        # Variants that would run the very same argv form one class and are replayed once.
+        try:
+            with ktest.KTest(testcase) as test:
+                files = len(test.sym_files()) > 0
+                empty = any(len(arg) == 0 for arg in test.argv()[1:])
+        except (OSError, ValueError):
+            files, empty = True, True
+        classes = dict()
+        for insert, drop in self.variants:
+            classes.setdefault((insert if files else None, drop and empty), list()).append((insert, drop))
+        return list(classes.values())
+
+    def select(self, classes):
+        if self.probed < self.probes or len(classes) == 1:
+            return classes
+        kept = [variants for variants in classes if any(variant in self.useful for variant in variants)]
+        return kept if len(kept) > 0 else classes[:1]
+
+    def wants_probe(self):
+        return self.probed < self.probes or self.replayed >= self.reprobe
+
+    def learn(self, classes, coverages):
+        # Greedily keep the classes needed to reach everything the test case covered under any variant
+        remaining = set().union(*coverages)
+        while len(remaining) > 0:
+            gains = [len(coverage & remaining) for coverage in coverages]
+            best = gains.index(max(gains))
+            if gains[best] == 0:
+                break
+            self.useful.update(classes[best])
+            remaining = remaining - coverages[best]
+        self.probed += 1
+        self.replayed = 0
+        if self.probed == self.probes:
+            kept = [variant for variant in self.variants if variant in self.useful]
+            print(f'[INFO] ORBiS : klee-replay variants kept after {self.probes} probes: {kept}')
+
+    def commands(self, target, testcase, classes=None):
+        classes = self.plan(testcase) if classes is None else classes
+        cmds = []
+        for insert, drop in [variants[0] for variants in classes]:
+            cmd = [str(self.bin), str(target), str(testcase)]
+            if insert is not None:
+                cmd.append(f"--insert-symfiles-argv={insert}")
+            if drop:
+                cmd.append("--drop-empty-args")
+            cmds.append(cmd)
+        return cmds
+
+    def replay(self, target, testcase, scratch, classes=None):
+        # Each test case runs in its own working directory and dumps its .gcda files under its own prefix
+        if classes is None:
+            classes = self.select(self.plan(testcase))
+            with self.lock:
+                self.replayed += 1
+        work_dir = scratch / 'cwd'
+        prefix = scratch / 'gcda'
+        work_dir.mkdir(parents=True)
+        prefix.mkdir(parents=True)
+        env = session.sessions().env(GCOV_PREFIX=str(prefix), GCOV_PREFIX_STRIP='0')
+        timeouts = 0
+        for cmd in self.commands(target, testcase, classes):
+            timeout = self.timeout
+            start = time.monotonic()
+            timed_out = False
+            try:
+                stderr = session.run(cmd, timeout=timeout, cwd=str(work_dir), env=env, grace=self.grace).stderr
+                latency = time.monotonic() - start
+            except sp.TimeoutExpired as e:
+                stderr = e.stderr
+                latency = timeout
+                timed_out = True
+            with self.lock:
+                self.latencies.append(latency)
+                self.timeouts += timed_out
+                self.replays += 1
+            timeouts += timed_out
+            self.remove_temps(stderr)
+        if timeouts > 0 and next(prefix.glob('**/*.gcda'), None) is None:
+            with self.lock:
+                self.lost += 1
+        return prefix
+
+    def remove_temps(self, stderr):
+        # klee-replay names its replay and sym-files directories on stderr (the bundled one makes the latter under TMPDIR).
+        # A killed replay leaves them behind, so those in /tmp or in the private TMPDIR of this run are removed here.
+        roots = {'/tmp', os.path.realpath(session.sessions().tmpdir)}
+        for path in set(KLEE_REPLAY_TEMP.findall(stderr or b'')):
+            path = os.path.realpath(path.decode(errors='replace'))
+            if os.path.dirname(path) in roots:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def replay_all(self, pool, target, testcases, scratch):
         target = Path(target).absolute()
-        original_path = Path().absolute()
-        for testcase in testcases:
-            testcase = Path(testcase).absolute()
-            os.chdir(str(target.parent))
-            cmds = []
-            cmds.append([str(self.bin), str(target), str(testcase), "--insert-symfiles-argv=after", "--drop-empty-args"])
-            cmds.append([str(self.bin), str(target), str(testcase), "--insert-symfiles-argv=before", "--drop-empty-args"])
-            cmds.append([str(self.bin), str(target), str(testcase), "--insert-symfiles-argv=after"])
-            cmds.append([str(self.bin), str(target), str(testcase), "--insert-symfiles-argv=before"])
-            cmds.append([str(self.bin), str(target), str(testcase)])
-
-            for cmd in cmds:
-                cmd = ' '.join(cmd)
-                process = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-                try:
-                    _, stderr = process.communicate(timeout=0.1)
-                except sp.TimeoutExpired:
-                    pass
-                finally:
-                    process.kill()
-
-        base = Path()
-        for _ in range(folder_depth):
-            base = base / '..'
-        gcda_pattern = base / '**/*.gcda'
-        gcdas = list(target.parent.glob(str(gcda_pattern)))
-        gcdas = [gcda.absolute() for gcda in gcdas]
+        futures = [pool.submit(self.replay, target, Path(testcase).absolute(), scratch / str(i)) for i, testcase in enumerate(testcases)]
+        return [future.result() for future in futures]
 
-        os.chdir(str(original_path))
+    def link_notes(self, profile):
+        # Place the .gcno of each object next to its relocated .gcda so that gcov can read the profile in place
+        gcdas = list(profile.glob('**/*.gcda'))
+        for gcda in gcdas:
+            gcno = gcda.with_suffix('.gcno')
+            origin = Path('/') / gcno.relative_to(profile)
+            if not gcno.exists() and origin.exists():
+                os.symlink(str(origin), str(gcno))
         return gcdas
 
+    def merge(self, profile1, profile2, output):
+        cmd = [str(self.gcov_tool), 'merge', '-o', str(output), str(profile1), str(profile2)]
+        _ = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, check=True)
+        return output
+
+    def reduce(self, pool, profiles, scratch):
+        # Merge profile directories pairwise until a single profile is left
+        profiles = [profile for profile in profiles if any(profile.glob('**/*.gcda'))]
+        level = 0
+        while len(profiles) > 1:
+            futures = list()
+            for i in range(0, len(profiles) - 1, 2):
+                output = scratch / f'merge-{level}-{i}'
+                futures.append(pool.submit(self.merge, profiles[i], profiles[i + 1], output))
+            merged = [future.result() for future in futures]
+            if len(profiles) % 2 == 1:
+                merged.append(profiles[-1])
+            profiles = merged
+            level += 1
+        return profiles[0] if len(profiles) > 0 else None
+
+    def run(self, target, testcases, scratch):
+        # Replay the test cases a batch at a time into scratch and fold each batch into one profile there, the object tree is left alone
+        target = Path(target).absolute()
+        profile = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for start in range(0, len(testcases), self.batch):
+                batch = scratch / f'batch-{start}'
+                profiles = self.replay_all(pool, target, testcases[start:start + self.batch], batch)
+                merged = self.reduce(pool, ([profile] if profile is not None else []) + profiles, batch)
+                if merged is not None and merged != profile:
+                    merged = merged.rename(scratch / f'profile-{start}')
+                    if profile is not None:
+                        shutil.rmtree(str(profile), ignore_errors=True)
+                    profile = merged
+                shutil.rmtree(str(batch), ignore_errors=True)
+        return profile
+
+
+class CoverageWorkspace:
+    def __init__(self, min_free=256 * 1024 * 1024):
+        self.gcdas = set()
+        self.gcovs = set()
+        # Replay scratch goes to tmpfs when there is room for it, otherwise to the default temporary directory
+        self.scratch_root = None
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            stat = os.statvfs('/dev/shm')
+            if stat.f_bavail * stat.f_frsize >= min_free:
+                self.scratch_root = '/dev/shm'
+
+    def index(self, root):
+        # Walk the object tree once: every .gcno tells where its .gcda would be written
+        for path, _, files in os.walk(root):
+            for file in files:
+                if file.endswith('.gcno') or file.endswith('.gcda'):
+                    self.gcdas.add(os.path.join(path, f'{file[:-5]}.gcda'))
+                elif file.endswith('.gcov'):
+                    self.gcovs.add(os.path.join(path, file))
+
+    def reset(self):
+        for path in self.gcdas | self.gcovs:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def scratch(self, prefix):
+        return Path(tempfile.mkdtemp(prefix=prefix, dir=self.scratch_root))
+
 
 class KLEEAnalyze:
-    def __init__(self, init_budget, gcov_path, klee_replay=None, gcov=None):
+    def __init__(self, init_budget, gcov_path, klee_replay=None, gcov=None, gcov_tool='gcov-tool', replay_jobs=None, per_testcase=False, replay_profile=None, registry=None):
         if klee_replay is None:
-            klee_replay = KLEEReplay()
+            klee_replay = KLEEReplay(gcov_tool=gcov_tool, jobs=replay_jobs, profile=replay_profile)
         elif isinstance(klee_replay, str):
-            klee_replay = KLEEReplay(klee_replay)
+            klee_replay = KLEEReplay(klee_replay, gcov_tool, replay_jobs, replay_profile)
         self.klee_replay = klee_replay
         if gcov is None:
             gcov = GCov()
@@ -175,22 +495,118 @@ class KLEEAnalyze:
         self.gcov = gcov
         self.gcov_path = gcov_path[:gcov_path.rfind('/')]
         self.budget = init_budget
+        self.per_testcase = per_testcase
+        self.registry = BranchRegistry() if registry is None else registry
+        # Digest of a test case -> bitset of the branches it covers
+        self.coverage_cache = dict()
+        self.testcase_coverage = dict()
+        self.timings = dict()
+        self.counts = dict()
+        self.workspace = CoverageWorkspace()
 
     def evaluate(self, target, testcases, folder_depth=1):
-        base = Path(target).parent
-        # Run symbolic executor
-        for _ in range(folder_depth):
-            base = base / '..'
-        cmd = ['rm', '-f', str(base / '**/*.gcda'), str(base / '**/*.gcov')]
-        cmd = ' '.join(cmd)
-        _ = sp.run(cmd, shell=True, check=True)
-        # Replay test-cases generated by the symbolic executor
-        gcdas = self.klee_replay.run(target, testcases, folder_depth=folder_depth)
-        # Extract the set of branches covered by the generated test-cases
-        branches = self.gcov.run(target, gcdas, folder_depth=folder_depth)
+        # Seconds spent in each phase and counts of the last evaluation, like testcase_coverage
+        start = time.monotonic()
+        replays, timeouts, lost = self.klee_replay.replays, self.klee_replay.timeouts, self.klee_replay.lost
+        self.timings = dict()
+        self.counts = dict()
+        self.probe(target, testcases, folder_depth)
+        self.timings['probe'] = time.monotonic() - start
+        if self.per_testcase:
+            branches = self.evaluate_testcases(target, testcases, folder_depth)
+        else:
+            # Replay test-cases generated by the symbolic executor and extract the set of branches they cover
+            scratch = self.workspace.scratch('orbis-replay-')
+            try:
+                phase = time.monotonic()
+                profile = self.klee_replay.run(target, testcases, scratch)
+                self.timings['replay'] = time.monotonic() - phase
+                phase = time.monotonic()
+                branches = set() if profile is None else set(self.measure(target, profile, folder_depth))
+                self.timings['gcov'] = time.monotonic() - phase
+            finally:
+                shutil.rmtree(str(scratch), ignore_errors=True)
+        self.klee_replay.tune()
+        self.timings['evaluate'] = time.monotonic() - start
+        self.counts['replays'] = self.klee_replay.replays - replays
+        self.counts['replay_timeouts'] = self.klee_replay.timeouts - timeouts
+        self.counts['lost_profiles'] = self.klee_replay.lost - lost
         return branches
 
 
+    def measure(self, target, profile, folder_depth=1):
+        gcdas = self.klee_replay.link_notes(profile)
+        return frozenset(self.gcov.run(target, gcdas, folder_depth=folder_depth, cleanup=True))
+
+
+    def probe(self, target, testcases, folder_depth=1, limit=4):
+        # Replay a few test cases one klee-replay variant class at a time to learn which variants add coverage
+        replayer = self.klee_replay
+        target = Path(target).absolute()
+        scratch = self.workspace.scratch('orbis-probe-')
+        try:
+            for n, testcase in enumerate(testcases):
+                if limit == 0 or not replayer.wants_probe():
+                    break
+                classes = replayer.plan(testcase)
+                if len(classes) < 2:
+                    continue
+                coverages = list()
+                for i, variants in enumerate(classes):
+                    profile = replayer.replay(target, Path(testcase).absolute(), scratch / f'{n}-{i}', [variants])
+                    coverages.append(self.measure(target, profile, folder_depth))
+                replayer.learn(classes, coverages)
+                limit -= 1
+        finally:
+            shutil.rmtree(str(scratch), ignore_errors=True)
+
+
+    def evaluate_testcases(self, target, testcases, folder_depth=1):
+        # Coverage of each test case is cached by the digest of its contents, so known test cases are never replayed again
+        self.testcase_coverage = dict()
+        fresh = dict()
+        for testcase in testcases:
+            with open(testcase, 'rb') as tc_f:
+                digest = hashlib.sha1(tc_f.read()).hexdigest()
+            if digest in self.coverage_cache:
+                self.testcase_coverage[str(Path(testcase).absolute())] = frozenset(self.registry.decode(self.coverage_cache[digest]))
+            else:
+                fresh.setdefault(digest, list()).append(testcase)
+        self.counts['cached'] = len(self.testcase_coverage)
+
+        if len(fresh) > 0:
+            digests = list(fresh.keys())
+            scratch = self.workspace.scratch('orbis-replay-')
+            try:
+                measured = list()
+                self.timings['replay'] = self.timings['gcov'] = 0
+                batch_size = self.klee_replay.batch
+                with ThreadPoolExecutor(max_workers=self.klee_replay.jobs) as pool:
+                    for start in range(0, len(digests), batch_size):
+                        # The profiles of a batch are measured and removed before the next batch is replayed
+                        batch = scratch / f'batch-{start}'
+                        phase = time.monotonic()
+                        profiles = self.klee_replay.replay_all(pool, target, [fresh[digest][0] for digest in digests[start:start + batch_size]], batch)
+                        self.timings['replay'] += time.monotonic() - phase
+                        phase = time.monotonic()
+                        if self.gcov.supports_json():
+                            # JSON reports are streamed to stdout, so the profiles can be read concurrently
+                            futures = [pool.submit(self.measure, target, profile, folder_depth) for profile in profiles]
+                            measured += [future.result() for future in futures]
+                        else:
+                            measured += [self.measure(target, profile, folder_depth) for profile in profiles]
+                        self.timings['gcov'] += time.monotonic() - phase
+                        shutil.rmtree(str(batch), ignore_errors=True)
+                for digest, branches in zip(digests, measured):
+                    self.coverage_cache[digest] = self.registry.encode(branches)
+                    for testcase in fresh[digest]:
+                        self.testcase_coverage[str(Path(testcase).absolute())] = branches
+            finally:
+                shutil.rmtree(str(scratch), ignore_errors=True)
+
+        return set().union(*self.testcase_coverage.values())
+
+
     def budget_handler(self, elapsed, total_budget, coverage, iteration, options):
         if iteration % len(options) == len(options) - 1:
             self.budget = self.budget * 2
@@ -202,42 +618,10 @@ class KLEEAnalyze:
             return total_budget - elapsed
 
 
-    def find_all(self, path, ends):
-        # Search for files in the current directory and all sub-directories
-        found = []
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith(f'.{ends}'):
-                    found.append(os.path.join(root, file))
-        return found
-
-
     def clear_gcov(self, depth):
         # Initialize ".gcda" and ".gcov" files
         g_path = self.gcov_path
         for _ in range(depth):
             g_path = g_path[:g_path.rfind('/')]
-        gcdas = self.find_all(g_path, "gcda")
-        gcovs = self.find_all(g_path, "gcov")
-        for gcda in gcdas:
-            os.system(f"rm -f {gcda}")
-        for gcov in gcovs:
-            os.system(f"rm -f {gcov}")
-
-    
-    def kill_tmp(self, mypass="1234"):    # mypass : Your sudo passwords
-        target_dir = "/tmp"
-        patterns = [
-            "klee-replay-[0-9A-Za-z]*",
-            "gcal[0-9A-Za-z]*",
-            "klee-symfiles-[0-9A-Za-z]*",
-            "pyright-[0-9A-Za-z]*",
-        ]
-
-        paths = []
-        for pat in patterns:
-            paths.extend(glob.glob(os.path.join(target_dir, pat)))
-
-        if paths:
-            for path in paths:
-                sp.run(["rm", "-rf", path], input=mypass + "\n", universal_newlines=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL, check=True)
+        self.workspace.index(g_path)
+        self.workspace.reset()
@@ -0,0 +1,170 @@
+import mmap
+import re
+import struct
+
+
+
+KTEST_MAGIC = b'KTEST'
+KTEST_VERSION = 3
+SYM_FILE = re.compile(r'^[A-Z]-data$')
+# Options of klee_init_env that take no part in argv, with the number of tokens each consumes
+ENV_FLAGS = {'sym-files' : 3, 'sym-stdin' : 2, 'sym-stdout' : 1, 'save-all-writes' : 1, 'fd-fail' : 1, 'max-fail' : 2}
+
+
+
+class KTest:
+    def __init__(self, path):
+        # The file is memory-mapped and objects are views into it, nothing is copied until asked for
+        self.path = str(path)
+        with open(self.path, 'rb') as ktest_f:
+            try:
+                self.buffer = mmap.mmap(ktest_f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self.buffer = b''
+        self.view = memoryview(self.buffer)
+        self.args = list()
+        self.objects = list()
+        self.sym_argvs = 0
+        self.sym_argv_len = 0
+        self.parse()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def parse(self):
+        view = self.view
+        if bytes(view[:5]) not in (KTEST_MAGIC, b'BOUT\n'):
+            raise ValueError(f"{self.path} is not a .ktest file")
+        offset = 5
+
+        def uint32():
+            nonlocal offset
+            if offset + 4 > len(view):
+                raise ValueError(f"{self.path} is truncated")
+            offset += 4
+            return struct.unpack_from('>I', view, offset - 4)[0]
+
+        def chunk():
+            nonlocal offset
+            size = uint32()
+            if offset + size > len(view):
+                raise ValueError(f"{self.path} is truncated")
+            offset += size
+            return view[offset - size:offset]
+
+        version = uint32()
+        self.args = [bytes(chunk()).decode(errors='replace') for _ in range(uint32())]
+        if version >= 2:
+            self.sym_argvs = uint32()
+            self.sym_argv_len = uint32()
+        for _ in range(uint32()):
+            name = bytes(chunk()).decode(errors='replace')
+            self.objects.append((name, chunk()))
+
+
+    def close(self):
+        for _, data in self.objects:
+            data.release()
+        self.objects = list()
+        self.view.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+    def object(self, name):
+        for key, data in self.objects:
+            if key == name:
+                return data
+        return None
+
+
+    def sym_files(self):
+        return {name[0] : data for name, data in self.objects if SYM_FILE.match(name)}
+
+
+    def stdin(self):
+        return self.object('stdin')
+
+
+    def argv(self, program=None):
+        # Arguments the replayed program receives, as klee_init_env builds them from the objects in order
+        objects = iter(self.objects)
+        argv = list()
+        args = self.args if program is None or len(self.args) == 0 else [program] + self.args[1:]
+        k = 0
+        while k < len(args):
+            flag = args[k][2:] if args[k].startswith('--') else args[k][1:] if args[k].startswith('-') else ''
+            if flag == 'sym-arg':
+                argv.append(c_string(next(objects, ('', b''))[1]))
+                k += 2
+            elif flag == 'sym-args':
+                try:
+                    min_argvs, max_argvs = int(args[k + 1]), int(args[k + 2])
+                except (IndexError, ValueError):
+                    raise ValueError(f"{self.path} has a malformed -sym-args")
+                n_args = min_argvs
+                if min_argvs < max_argvs:
+                    # klee_range(min, max + 1, "n_args") makes an object only when the range holds more than one value
+                    name, data = next(objects, ('', b''))
+                    if name != 'n_args':
+                        raise ValueError(f"{self.path} has no n_args object for -sym-args")
+                    n_args = struct.unpack('<i', bytes(data[:4]).ljust(4, b'\0'))[0]
+                    if not min_argvs <= n_args <= max_argvs:
+                        raise ValueError(f"{self.path} has n_args {n_args} outside [{min_argvs}, {max_argvs}]")
+                for _ in range(n_args):
+                    argv.append(c_string(next(objects, ('', b''))[1]))
+                k += 4
+            elif flag in ENV_FLAGS:
+                k += ENV_FLAGS[flag]
+            else:
+                argv.append(args[k])
+                k += 1
+        # klee-replay cuts two-character arguments starting with 'A' to "A" in place while printing them (klee-replay.c),
+        # so this is what both its "Arguments:" line and the replayed program see
+        return [arg[:1] if len(arg) == 2 and arg[0] == 'A' else arg for arg in argv]
+
+
+def c_string(data):
+    data = bytes(data)
+    return data[:data.index(b'\0')].decode(errors='replace') if b'\0' in data else data.decode(errors='replace')
+
+
+def pack_uint32(value):
+    return struct.pack('>I', value)
+
+
+def pack_bytes(data):
+    return pack_uint32(len(data)) + data
+
+
+def dumps(args, objects, sym_argvs=0, sym_argv_len=0):
+    # Same layout as kTest_toFile: big-endian lengths, arguments, then (name, bytes) objects
+    chunks = [KTEST_MAGIC, pack_uint32(KTEST_VERSION), pack_uint32(len(args))]
+    chunks += [pack_bytes(arg.encode()) for arg in args]
+    chunks += [pack_uint32(sym_argvs), pack_uint32(sym_argv_len), pack_uint32(len(objects))]
+    for name, data in objects:
+        chunks += [pack_bytes(name.encode()), pack_bytes(bytes(data))]
+    return b''.join(chunks)
+
+
+def write(path, args, objects, sym_argvs=0, sym_argv_len=0):
+    with open(path, 'wb') as ktest_f:
+        ktest_f.write(dumps(args, objects, sym_argvs, sym_argv_len))
+
+
+def gen_bout(arguments, program='gen-bout'):
+    # What "gen-bout ARG ..." writes: one NUL-terminated object per argument and the POSIX model version
+    args = [program]
+    objects = list()
+    for k, argument in enumerate(arguments):
+        data = argument.encode() + b'\0'
+        objects.append((f"arg{k:02d}", data))
+        args += ["-sym-arg", str(len(data) - 1)]
+    objects.append(("model_version", struct.pack('<I', 1)))
+    return dumps(args, objects)
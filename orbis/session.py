@@ -0,0 +1,113 @@
+import atexit
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+
+import subprocess as sp
+
+
+
+class Sessions:
+    def __init__(self, tmp_root=None):
+        # Every process runs in a session of its own and its group is tracked until it is killed as a whole
+        self.tmpdir = tempfile.mkdtemp(prefix='orbis-run-', dir=tmp_root)
+        self.groups = set()
+        self.lock = threading.Lock()
+        self.terminated = False
+
+
+    def env(self, **variables):
+        # Programs that honor TMPDIR leave their temporary files in the private directory of this run
+        return dict(os.environ, TMPDIR=self.tmpdir, **variables)
+
+
+    def run(self, cmd, timeout=None, check=False, env=None, grace=0, **kwargs):
+        # Same contract as subprocess.run with captured output, except that a timeout kills the whole group.
+        # With a grace period the group gets SIGTERM first, so a program that exits on it can still write its .gcda files.
+        if self.terminated:
+            raise sp.SubprocessError('ORBiS is terminating')
+        process = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, start_new_session=True, env=self.env() if env is None else env, **kwargs)
+        with self.lock:
+            self.groups.add(process.pid)
+            terminated = self.terminated
+        if terminated:
+            self.kill(process.pid)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except sp.TimeoutExpired:
+            if grace > 0:
+                self.signal(process.pid, signal.SIGTERM)
+                try:
+                    process.communicate(timeout=grace)
+                except sp.TimeoutExpired:
+                    pass
+            self.kill(process.pid)
+            stdout, stderr = process.communicate()
+            raise sp.TimeoutExpired(process.args, timeout, output=stdout, stderr=stderr)
+        finally:
+            # Children the process left behind (e.g., the program klee-replay runs) go with its group
+            self.kill(process.pid)
+        if self.terminated:
+            # Killed by terminate(): the thread waiting on it returns at once instead of reporting a failed run
+            raise sp.SubprocessError('ORBiS is terminating')
+        if check and process.returncode != 0:
+            raise sp.CalledProcessError(process.returncode, process.args, stdout, stderr)
+        return sp.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+
+    def signal(self, pgid, signum):
+        try:
+            os.killpg(pgid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+    def kill(self, pgid):
+        self.signal(pgid, signal.SIGKILL)
+        with self.lock:
+            self.groups.discard(pgid)
+
+
+    def terminate(self):
+        # Only the groups of this run are killed, so campaigns sharing a host leave each other alone
+        with self.lock:
+            self.terminated = True
+            groups = list(self.groups)
+        for pgid in groups:
+            self.kill(pgid)
+
+
+    def close(self):
+        self.terminate()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+active = None
+active_lock = threading.Lock()
+
+
+def sessions():
+    # One Sessions per driver process, created on first use and closed at exit
+    global active
+    with active_lock:
+        if active is None:
+            active = Sessions()
+            atexit.register(active.close)
+    return active
+
+
+def run(cmd, **kwargs):
+    return sessions().run(cmd, **kwargs)
+
+
+def terminate_on_sigterm():
+    # SIGTERM kills the groups right away, as threads waiting on them are joined before the exit handlers run.
+    # The driver then ends through SystemExit and the exit handlers remove its TMPDIR.
+    def terminate(signum, frame):
+        if active is not None:
+            active.terminate()
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, terminate)
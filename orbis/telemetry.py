@@ -0,0 +1,74 @@
+import json
+import os
+import pstats
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+
+class Telemetry:
+    def __init__(self, path=None, events=0):
+        # Phases are accumulated per iteration from any thread and written as one JSON line when the iteration is recorded
+        self.path = path
+        self.events = events
+        self.phases = dict()
+        self.counts = dict()
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+
+    @contextmanager
+    def phase(self, iteration, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(iteration, {name : time.monotonic() - start})
+
+
+    def add(self, iteration, phases=None, counts=None):
+        with self.lock:
+            for name, seconds in (phases or dict()).items():
+                iteration_phases = self.phases.setdefault(iteration, dict())
+                iteration_phases[name] = iteration_phases.get(name, 0) + seconds
+            for name, count in (counts or dict()).items():
+                iteration_counts = self.counts.setdefault(iteration, dict())
+                iteration_counts[name] = iteration_counts.get(name, 0) + count
+
+
+    def scan(self, iteration, iteration_dir):
+        # What the replayer (.ktest) and the Guider (.const) read of the iteration
+        counts = dict()
+        if os.path.exists(iteration_dir):
+            for entry in os.scandir(iteration_dir):
+                for suffix in ('ktest', 'const'):
+                    if entry.name.endswith(f'.{suffix}'):
+                        counts[suffix] = counts.get(suffix, 0) + 1
+                        counts[f'{suffix}_bytes'] = counts.get(f'{suffix}_bytes', 0) + entry.stat().st_size
+        self.add(iteration, counts=counts)
+
+
+    def emit(self, iteration, **fields):
+        with self.lock:
+            phases = self.phases.pop(iteration, dict())
+            counts = self.counts.pop(iteration, dict())
+        event = dict(iteration=iteration, time=round(time.monotonic() - self.start, 6), **fields)
+        event['phases'] = {name : round(seconds, 6) for name, seconds in phases.items()}
+        event['counts'] = counts
+        if self.path is not None:
+            with open(self.path, 'a') as events_f:
+                events_f.write(json.dumps(event) + '\n')
+            self.events += 1
+        return event
+
+
+def dump_profile(profiler, path, limit=40):
+    profiler.disable()
+    profiler.dump_stats(f"{path}.pstats")
+    with open(f"{path}.txt", 'w') as profile_f:
+        stats = pstats.Stats(profiler, stream=profile_f)
+        stats.sort_stats('cumulative').print_stats(limit)
+        stats.sort_stats('tottime').print_stats(limit)
+    print(f'[INFO] ORBiS : Hot functions of the driver are written to "{path}.txt" (raw statistics in "{path}.pstats").')
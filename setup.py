@@ -14,12 +14,12 @@ setup(
     setup_requires=[],
     install_requires=[
         'numpy',
-        "scikit-learn"
     ],
     dependency_links=[],
     entry_points={
         'console_scripts': [
             'orbis=orbis.bin:main',
+            'orbis-worker=orbis.distribute:main',
         ]
     }
 )
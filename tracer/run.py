@@ -1,11 +1,16 @@
 from argparse import ArgumentParser
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import ast
 import json
 import os
 import re
+import signal
 import sys
+import tempfile
 
 import subprocess as sp
 
@@ -61,7 +66,7 @@ def get_gcovs(running_dir, gcov_obj, src_depth):
     os.chdir(running_dir)
 
 
-def get_cmd_log(running_dir, program, start_arg, end_arg, option=""):
+def get_cmd_log(running_dir, program, start_arg, end_arg, option="", timeout=0.1):
     def is_tuple_string(s):
         try:
             return isinstance(ast.literal_eval(s), tuple)
@@ -70,59 +75,138 @@ def get_cmd_log(running_dir, program, start_arg, end_arg, option=""):
 
     cmd = f"{start_arg} {running_dir}/execs/{program}_trace {option} {end_arg}".strip()
     cmd = [x.strip() for x in cmd.split()]
-    try:
-        result = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, timeout=0.1)
-    except sp.TimeoutExpired as e:
-        result = sp.CompletedProcess(e.cmd, returncode=None, stdout=e.stdout, stderr=e.stderr)
-    except:
-        return "ERRORED"
-    output_str = result.stdout
+    # Each trace runs in its own session with a private TMPDIR, so whatever it spawns is killed with it on timeout
+    with tempfile.TemporaryDirectory(prefix=f"{program}_trace-") as tmp_dir:
+        env = dict(os.environ, TMPDIR=tmp_dir)
+        try:
+            proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, env=env, start_new_session=True)
+        except:
+            return "ERRORED"
+        try:
+            output_str, _ = proc.communicate(timeout=timeout)
+        except sp.TimeoutExpired:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            output_str, _ = proc.communicate()
+        except:
+            return "ERRORED"
     logs = [ast.literal_eval(l) for l in output_str.split('\n') if is_tuple_string(l)]
     logs = [logs for logs in logs if logs[1] != "<unknown>"]
     return set(logs)
 
 
-def extract_function_block(file_path, func_name):
-    if not os.path.exists(file_path):
-        return None, None
+FUNCTION_TAIL = re.compile(r"\s*\([^;{]*\)(?:[^;{]*)\{", re.MULTILINE | re.DOTALL)
 
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        code = f.read()
 
-    name_escaped = re.escape(func_name)
+class SourceIndex:
+    # Source and .gcov files are parsed once per run, the same files and functions recur across options
+    def __init__(self):
+        self.sources = dict()
+        self.functions = dict()
+        self.conditions = dict()
+        self.gcovs = dict()
 
-    pat = (
-        r"\b" + name_escaped + r"\b"
-        r"\s*\([^;{]*\)"
-        r"(?:[^;{]*)\{"
-    )
 
-    m = re.search(pat, code, re.MULTILINE | re.DOTALL)
-    if not m:
-        return None, None
+    def source(self, file_path):
+        if file_path not in self.sources:
+            if not os.path.exists(file_path):
+                self.sources[file_path] = None
+                return None
+
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                code = f.read()
+
+            newlines = [m.start() for m in re.finditer("\n", code)]
+            braces = dict()
+            stack = []
+            for m in re.finditer(r"[{}]", code):
+                if m.group() == "{":
+                    stack.append(m.start())
+                elif len(stack) > 0:
+                    braces[stack.pop()] = m.start()
 
-    brace_index = code.find("{", m.end() - 1)
-    if brace_index == -1:
-        return None, None
+            # First place each name is followed by "(...) ... {", as a search for that name alone would find
+            heads = dict()
+            for m in re.finditer(r"\b(\w+)(?=\s*\()", code):
+                if m.group(1) not in heads:
+                    tail = FUNCTION_TAIL.match(code, m.end())
+                    if tail:
+                        heads[m.group(1)] = (m.start(), tail.end())
+            self.sources[file_path] = (code, newlines, braces, heads)
+        return self.sources[file_path]
 
-    start_line_no = code[:m.start()].count("\n") + 1
 
-    depth = 0
-    end_index = None
-    for i in range(brace_index, len(code)):
-        ch = code[i]
-        if ch == "{":
-            depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0:
-                end_index = i
-                break
+    def function_block(self, file_path, func_name):
+        key = (file_path, func_name)
+        if key not in self.functions:
+            self.functions[key] = self.extract_function_block(file_path, func_name)
+        return self.functions[key]
 
-    if end_index is None:
-        return None, None
 
-    return code[m.start():end_index + 1], start_line_no
+    def extract_function_block(self, file_path, func_name):
+        source = self.source(file_path)
+        if source is None:
+            return None, None
+        code, newlines, braces, heads = source
+
+        if re.fullmatch(r"\w+", func_name):
+            head = heads.get(func_name)
+        else:
+            m = re.search(r"\b" + re.escape(func_name) + r"\b" + FUNCTION_TAIL.pattern, code, re.MULTILINE | re.DOTALL)
+            head = (m.start(), m.end()) if m else None
+        if head is None:
+            return None, None
+        start, end = head
+
+        brace_index = code.find("{", end - 1)
+        if brace_index == -1:
+            return None, None
+
+        start_line_no = bisect_left(newlines, start) + 1
+
+        end_index = braces.get(brace_index)
+        if end_index is None:
+            return None, None
+
+        return code[start:end_index + 1], start_line_no
+
+
+    def condition_lines(self, log):
+        if log not in self.conditions:
+            func_code, start_line = self.function_block(log[-1], log[0])
+            if func_code is None:
+                self.conditions[log] = None
+            else:
+                self.conditions[log] = extract_condition_lines(func_code, log[1], log[2], start_line)
+        return self.conditions[log]
+
+
+    def branch_lines(self, gcov_file):
+        # Source line number -> indices of the branch lines that follow its first occurrence in the .gcov file
+        if gcov_file not in self.gcovs:
+            branches = dict()
+            try:
+                with open(gcov_file, "r") as gcov_f:
+                    lines = [l.strip() for l in gcov_f.readlines()]
+            except:
+                lines = []
+            current = None
+            for i, line in enumerate(lines):
+                l_data = [d.strip() for d in line.split(":")]
+                if len(l_data) >= 2 and l_data[1].isdigit():
+                    current = l_data[1] if l_data[1] not in branches else None
+                    if current is not None:
+                        branches[current] = []
+                if current is not None:
+                    if ('branch' in line) and (":" not in line) and ("returned 0% blocks executed 0%" not in line):
+                        branches[current].append(i)
+            self.gcovs[gcov_file] = branches
+        return self.gcovs[gcov_file]
+
+
+source_index = SourceIndex()
 
 
 def extract_condition_lines(func_code, var_name, value, func_start_line_no):
@@ -166,6 +250,29 @@ def extract_condition_lines(func_code, var_name, value, func_start_line_no):
     return results
 
 
+def trace_option(running_dir, program, start_arg, end_arg, target_parent, src_depth, timeout, option):
+    logs = get_cmd_log(running_dir, program, start_arg, end_arg, option, timeout)
+    if logs == "ERRORED":
+        return logs
+
+    branches = None
+    for log in logs:
+        cond_lines = source_index.condition_lines(log)
+        if cond_lines is None:
+            continue
+        branches = set() if branches is None else branches
+
+        if len(cond_lines) > 0:
+            rel_file = log[-1][log[-1].rfind("../") + 3:]
+            rel_path = f"{'../' * (src_depth + 1)}{rel_file}"
+            gcov_file = f"{target_parent}/{rel_file[rel_file.rfind('/') + 1:]}.gcov"
+            branch_lines = source_index.branch_lines(gcov_file)
+            for cond_line in cond_lines:
+                for i in branch_lines.get(str(cond_line[0]), []):
+                    branches.add(f"{rel_path} {i}")
+    return None if branches is None else sorted(branches)
+
+
 
 def main(*argv):
     parser = ArgumentParser()
@@ -177,6 +284,10 @@ def main(*argv):
                         help='The arguments that is placed after the execution program to generate a valid argument (Default : None)')
     parser.add_argument('-d', '--src-depth', default=1, type=int, metavar='INT',
                         help='The depth from the directory where gcov is built to the directory where the execution file is defined (Default : 1)')
+    parser.add_argument('-j', '--jobs', default=1, type=int, metavar='INT',
+                        help='The number of options traced in parallel (Default : 1)')
+    parser.add_argument('-t', '--timeout', default=0.1, type=float, metavar='FLOAT',
+                        help='The time limit in seconds of each traced execution (Default : 0.1)')
     parser.add_argument('gcov_obj', nargs='?', default=None,
                         help='The path of the execution file that generates the .gcda files')
 
@@ -186,7 +297,7 @@ def main(*argv):
     target_parent = args.gcov_obj[:args.gcov_obj.rfind("/")]
     opt_branches = dict()
 
-    options = get_help_output(args.program, args.gcov_obj)
+    options = sorted(get_help_output(args.program, args.gcov_obj))
     get_gcovs(os.getcwd(), args.gcov_obj, args.src_depth)
 
     if os.path.exists(f"../data/option_dict/{args.program}.dict"):
@@ -195,44 +306,20 @@ def main(*argv):
             options = [opt for opt in options if opt[0] != "#"]
 
     errored = []
-    default_logs = get_cmd_log(os.getcwd(), args.program, args.start_arg, args.end_arg)
-    for option in options:
-        logs = get_cmd_log(os.getcwd(), args.program, args.start_arg, args.end_arg, option)
-        if logs == "ERRORED":
+    default_logs = get_cmd_log(os.getcwd(), args.program, args.start_arg, args.end_arg, timeout=args.timeout)
+    trace = partial(trace_option, os.getcwd(), args.program, args.start_arg, args.end_arg, target_parent, args.src_depth, args.timeout)
+    if args.jobs > 1:
+        # map() keeps the order of the options, so the result does not depend on which trace finishes first
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(trace, options, chunksize=4))
+    else:
+        results = map(trace, options)
+
+    for option, branches in zip(options, results):
+        if branches == "ERRORED":
             errored.append(option)
-            continue
-            
-        branches = set()
-        for log in logs:
-            func_code, start_line = extract_function_block(log[-1], log[0])
-            if func_code is None:
-                continue
-
-            cond_lines = extract_condition_lines(func_code, log[1], log[2], start_line)
-            if len(cond_lines) > 0:
-                rel_file = log[-1][log[-1].rfind("../") + 3:]
-                rel_path = f"{'../' * (args.src_depth + 1)}{rel_file}"
-                gcov_file = f"{target_parent}/{rel_file[rel_file.rfind('/') + 1:]}.gcov"
-                try:
-                    with open(gcov_file, "r") as gcov_f:
-                        lines = [l.strip() for l in gcov_f.readlines()]
-                    for cond_line in cond_lines:
-                        flag = 0
-                        for i, line in enumerate(lines):
-                            l_data = [d.strip() for d in line.split(":")]
-                            if len(l_data) >= 2:
-                                if l_data[1] == str(cond_line[0]):
-                                    flag = 1
-                            if flag:
-                                if ('branch' in line) and (":" not in line) and ("returned 0% blocks executed 0%" not in line):
-                                    branches.add(f"{rel_path} {i}")
-                                else:
-                                    if len(l_data) > 1:
-                                        if (l_data[1].isdigit()) and (not l_data[1] == str(cond_line[0])):
-                                            break
-                except:
-                    pass
-            opt_branches[option] = list(branches)
+        elif branches is not None:
+            opt_branches[option] = branches
 
     options = [opt for opt in options if opt not in errored]
 